@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+# Throughput benchmarks over the synthetic inputs in generators.py.
+#
+#   python benchmarks/bench.py --rows 20000 --output results.json
+#   python benchmarks/bench.py --compare results.json
+#
+# delim is imported from the checkout this script is in, so it runs
+# without PYTHONPATH being set.
+#
+# Each (case, mode) pair runs in a fresh interpreter, so peak_rss_kb (the
+# process's peak resident size) isn't inflated by earlier runs. seconds is
+# the best of --repeat runs. The backtracks and transitions of each case
+# are counted once, in a separate pass with Parser.collect_stats(), so the
+# timings don't include it.
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from delim.parser import Parser, BacktrackException
+from delim.parallel import parse_file_parallel
+from delim.writer import transcode
+from generators import CASES, get_case, generate
+
+MODES = ['parse', 'compiled', 'iter_records', 'iter_batches', 'mmap', 'parallel', 'transcode']
+
+# Modes that parse the generated text rather than the file
+TEXT_MODES = ['parse', 'compiled']
+
+ENCODING = 'utf-8'
+
+
+def make_parser(case):
+    parser = Parser(case.field_count, u',', case.newline)
+    case.configure(parser)
+    return parser
+
+
+def output_dialect(case):
+    # Tab separated, quoted where needed, for the transcode mode
+    dialect = Parser(case.field_count, u'\t', 'UNIX')
+    dialect.set_quotechar(u'"')
+    dialect.doublequote = True
+    return dialect
+
+
+def parse_all(parser, text):
+    index = 0
+    count = 0
+    while index < len(text):
+        record, index = parser.parse(text, index, True)
+        count += 1
+    return count
+
+
+def count_records(records):
+    count = 0
+    for record in records:
+        count += 1
+    return count
+
+
+def run_mode(mode, case, text, path):
+    parser = make_parser(case)
+    if mode == 'parse':
+        return parse_all(parser, text)
+    elif mode == 'compiled':
+        parser.compile()
+        return parse_all(parser, text)
+    elif mode == 'iter_records':
+        with open(path, 'rb') as f:
+            return count_records(parser.iter_records(f, ENCODING))
+    elif mode == 'iter_batches':
+        with open(path, 'rb') as f:
+            return sum(len(batch) for batch in parser.iter_batches(f, ENCODING))
+    elif mode == 'mmap':
+        return count_records(parser.iter_mmap_records(path, ENCODING))
+    elif mode == 'parallel':
+        return count_records(parse_file_parallel(path, parser, encoding=ENCODING))
+    elif mode == 'transcode':
+        with open(path, 'rb') as f, open(os.devnull, 'wb') as out:
+            return transcode(f, out, parser, output_dialect(case), ENCODING)
+    raise ValueError("Unknown mode %r" % mode)
+
+
+def peak_rss_kb():
+    # On Linux, ru_maxrss carries over from the parent process, but VmHWM
+    # starts again in a new program
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(case_name, mode, rows, seed, repeat, path):
+    # Runs in a child process, see run()
+    case = get_case(case_name)
+    # The other modes read the file, and shouldn't pay for the text in
+    # peak_rss_kb
+    text = generate(case, rows, seed) if mode in TEXT_MODES else None
+    best = None
+    for i in range(repeat):
+        started = timeit.default_timer()
+        records = run_mode(mode, case, text, path)
+        seconds = timeit.default_timer() - started
+        if best is None or seconds < best:
+            best = seconds
+    size = os.path.getsize(path)
+    return {
+        'case': case_name,
+        'mode': mode,
+        'records': records,
+        'bytes': size,
+        'seconds': best,
+        'records_per_second': records / best,
+        'mb_per_second': size / best / 1e6,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def count_work(case, text):
+    parser = make_parser(case)
+    stats = parser.collect_stats()
+    try:
+        parse_all(parser, text)
+    except BacktrackException:
+        pass
+    return {
+        'backtracks': stats.total_backtracks,
+        'transitions': stats.transitions,
+        'failed_records': stats.failed_records,
+        'backtracks_by_state': dict((name, count) for name, count in stats.backtracks.iteritems() if count),
+    }
+
+
+def run(case_names, modes, rows, seed, repeat):
+    results = []
+    for case_name in case_names:
+        case = get_case(case_name)
+        text = generate(case, rows, seed)
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(text.encode(ENCODING))
+            work = count_work(case, text)
+            for mode in modes:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                    '--run-case', case_name, mode, path,
+                    '--rows', str(rows), '--seed', str(seed), '--repeat', str(repeat)])
+                result = json.loads(output)
+                result.update(work)
+                results.append(result)
+                print >>sys.stderr, "%-18s %-13s %10.0f records/s %8.2f MB/s %8i KB %8i backtracks" % (
+                    case_name, mode, result['records_per_second'], result['mb_per_second'],
+                    result['peak_rss_kb'], result['backtracks'])
+        finally:
+            os.remove(path)
+    return results
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results, tolerance):
+    # Print the change in records/s against baseline, and return the
+    # (case, mode) pairs that slowed down by more than tolerance
+    old = dict(((r['case'], r['mode']), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        key = (result['case'], result['mode'])
+        if key not in old:
+            continue
+        ratio = result['records_per_second'] / old[key]['records_per_second']
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(key)
+            flag = ' REGRESSION'
+        print "%-18s %-13s %6.2fx%s" % (key[0], key[1], ratio, flag)
+    return regressions
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark delim over synthetic inputs")
+    argparser.add_argument('--cases', nargs='+', choices=[case.name for case in CASES],
+                           default=[case.name for case in CASES])
+    argparser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    argparser.add_argument('--rows', type=int, default=10000)
+    argparser.add_argument('--seed', type=int, default=0)
+    argparser.add_argument('--repeat', type=int, default=3)
+    argparser.add_argument('--output', help="write the results to this JSON file")
+    argparser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    argparser.add_argument('--tolerance', type=float, default=0.1,
+                           help="slowdown that counts as a regression in --compare")
+    argparser.add_argument('--run-case', nargs=3, metavar=('CASE', 'MODE', 'PATH'),
+                           help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.run_case:
+        case_name, mode, path = args.run_case
+        print json.dumps(run_case(case_name, mode, args.rows, args.seed, args.repeat, path))
+        return
+
+    results = run(args.cases, args.modes, args.rows, args.seed, args.repeat)
+    output = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'rows': args.rows,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import random
+import string
+from collections import namedtuple
+
+# Synthetic inputs for bench.py. Each case is generated from a seeded
+# random.Random, so the same rows and seed always give the same text.
+#
+# make_row(rng, i) returns the text of row i without its linebreak, and
+# configure(parser) sets the dialect options the case needs on a
+# Parser(field_count, u',', newline).
+
+Case = namedtuple('Case', 'name field_count newline configure make_row')
+
+LINEBREAKS = {'UNIX': u'\n', 'MAC': u'\r', 'DOS': u'\r\n'}
+
+LETTERS = unicode(string.ascii_lowercase)
+
+
+def word(rng, low=3, high=12):
+    return u''.join(rng.choice(LETTERS) for i in range(rng.randint(low, high)))
+
+
+def words(rng, count):
+    return [word(rng) for i in range(count)]
+
+
+# Validators are module level functions, so parsers can be pickled for
+# parse_file_parallel()
+def is_number(field):
+    return field.isdigit()
+
+
+def no_options(parser):
+    pass
+
+
+def quoting(parser):
+    parser.set_quotechar(u'"')
+    parser.doublequote = True
+
+
+def long_quoting(parser):
+    quoting(parser)
+    parser.max_field_length = 8192
+
+
+def unclosed_quoting(parser):
+    quoting(parser)
+    parser.unclosedquoting = True
+
+
+def spare_delimiters(parser):
+    parser.allow_unquoted_delimiters_in_field(1)
+    parser.allow_unquoted_delimiters_in_field(3)
+    # Without this, field 1 could take every spare delimiter in the row
+    parser.add_validation_rules(2, is_number)
+
+
+def escapes(parser):
+    parser.set_escapechar(u'\\')
+
+
+def clean_row(rng, i):
+    return u','.join(words(rng, 8))
+
+
+def wide_row(rng, i):
+    return u','.join(words(rng, 200))
+
+
+def long_quoted_row(rng, i):
+    text = u' '.join(words(rng, 300))[:rng.randint(1000, 3000)]
+    return u'%i,"%s","%s",%s' % (i, text, text[::-1], word(rng))
+
+
+def doubled_quotes_row(rng, i):
+    fields = [u'"%s"' % u'""'.join(words(rng, 4)) for j in range(3)]
+    return u','.join([unicode(i)] + fields)
+
+
+def unclosed_quotes_row(rng, i):
+    # One row in ten has a field that opens a quote and never closes it
+    fields = words(rng, 4)
+    if i % 10 == 0:
+        fields[2] = u'"' + fields[2]
+    else:
+        fields[2] = u'"%s"' % fields[2]
+    return u','.join(fields)
+
+
+def spare_delimiters_row(rng, i):
+    # Fields 1 and 3 hold up to three unquoted delimiters
+    fields = [word(rng), u','.join(words(rng, rng.randint(1, 4))), unicode(i),
+              u','.join(words(rng, rng.randint(1, 4))), word(rng), word(rng)]
+    return u','.join(fields)
+
+
+def escapes_row(rng, i):
+    fields = []
+    for j in range(5):
+        parts = words(rng, rng.randint(1, 3))
+        fields.append(rng.choice([u'\\,', u'\\\\', u'\\\n']).join(parts))
+    return u','.join(fields)
+
+
+CASES = [
+    Case('clean', 8, 'UNIX', no_options, clean_row),
+    Case('clean_crlf', 8, 'DOS', no_options, clean_row),
+    Case('clean_cr', 8, 'MAC', no_options, clean_row),
+    Case('wide', 200, 'UNIX', no_options, wide_row),
+    Case('long_quoted', 4, 'UNIX', long_quoting, long_quoted_row),
+    Case('doubled_quotes', 4, 'UNIX', quoting, doubled_quotes_row),
+    Case('unclosed_quotes', 4, 'UNIX', unclosed_quoting, unclosed_quotes_row),
+    Case('spare_delimiters', 6, 'UNIX', spare_delimiters, spare_delimiters_row),
+    Case('escapes', 5, 'DOS', escapes, escapes_row),
+]
+
+
+def get_case(name):
+    for case in CASES:
+        if case.name == name:
+            return case
+    raise KeyError(name)
+
+
+def generate(case, rows, seed=0):
+    rng = random.Random(seed)
+    linebreak = LINEBREAKS[case.newline]
+    return u''.join(case.make_row(rng, i) + linebreak for i in range(rows))
@@ -0,0 +1,571 @@
+import re
+import time
+
+from parser import BacktrackException, RecordLimitException, CR, LF, SPACE
+
+# Generate a parse function specialized for a Parser's current configuration.
+#
+# The generated function runs the same states as Parser.run(), with the
+# same order of alternatives, but as one loop over local variables: params
+# are unpacked into index, field_index, start and prefix, the dialect
+# characters are inlined as constants, and code for features that are
+# switched off (quoting, escapes, spare delimiters and linebreaks,
+# validators, nullstrings, interning, record limits, projection) isn't
+# generated at all.
+# Failures don't raise until there are no alternatives left. See
+# Parser.compile().
+#
+# The states that only choose between alternatives are inlined, so a
+# record takes fewer transitions here than in Parser.run_checked().
+#
+# With an encoding, the function parses a byte string (or an mmap or
+# buffer) instead, see Parser.parse_bytes(). The dialect characters are
+# then byte literals, and each field is decoded as it's closed, so fields
+# that aren't selected are never decoded. Indexes and max_field_length
+# count bytes.
+
+(START_FIELD,
+ IN_UNQUOTED_FIELD,
+ CLOSING_DELIMITER,
+ IN_QUOTED_FIELD,
+ QUOTE_IN_QUOTED_FIELD,
+ IN_UNCLOSED_QUOTED_FIELD,
+ IN_MINIMALLY_QUOTED_FIELD,
+ EMIT,
+ EMIT_AFTER_1,
+ EMIT_AFTER_2,
+ FAIL) = range(11)
+
+
+class Source(object):
+    def __init__(self):
+        self.lines = []
+        self.level = 0
+
+    def __call__(self, *lines):
+        for line in lines:
+            self.lines.append('    '*self.level + line)
+        return self
+
+    def __enter__(self):
+        self.level += 1
+
+    def __exit__(self, *exc_info):
+        self.level -= 1
+
+    def __str__(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+class Generator(object):
+    def __init__(self, parser, encoding=None):
+        self.parser = parser
+        self.encoding = encoding
+        self.empty = u'' if encoding is None else b''
+        self.src = Source()
+        self.linebreak = {u'UNIX': LF, u'MAC': CR, u'DOS': CR}[parser.newline]
+        self.quoting = parser.quoting and parser.quotechar is not None
+
+    def generate(self):
+        p = self.parser
+        src = self.src
+        src('def parse(charbuffer, startindex=0, buffer_is_final=True):')
+        with src:
+            src('length = len(charbuffer)',
+                'record = [None]*%i' % p.field_count,
+                'index = startindex',
+                'field_index = 0',
+                'start = startindex',
+                'prefix = %r' % self.empty,
+                'alternatives = []',
+                'message = None',
+                'state = %i' % START_FIELD)
+            if p.cached_validation_fields:
+                src('results = {}')
+            self.limits_setup()
+            src('while True:')
+            with src:
+                self.limits_check()
+                self.in_unquoted_field()
+                self.start_field()
+                self.closing_delimiter()
+                if self.quoting:
+                    self.in_quoted_field()
+                    self.quote_in_quoted_field()
+                    if p.unclosedquoting:
+                        self.in_unclosed_quoted_field()
+                    if p.minimalquoting:
+                        self.in_minimally_quoted_field()
+                for state, advance in ((EMIT, 0), (EMIT_AFTER_1, 1), (EMIT_AFTER_2, 2)):
+                    src('elif state == %i:' % state)
+                    with src:
+                        self.close_field(True, advance)
+                self.fail_state()
+        return str(src)
+
+    ###########################################################################
+    # Snippets
+
+    def char(self, c):
+        # A literal for the dialect character c
+        if self.encoding is None:
+            return repr(c)
+        return repr(c.encode('ascii'))
+
+    def fail(self, message):
+        self.src('message = %r' % message,
+                 'state = %i' % FAIL,
+                 'continue')
+
+    def need_more(self):
+        self.src("raise IndexError('string index out of range')")
+
+    def get_char(self, name, lookahead=0, at_eof=None):
+        # Read charbuffer[index+lookahead] into name. at_eof generates the
+        # code to run at the end of a final buffer; it fails by default.
+        src = self.src
+        position = 'index+%i' % lookahead if lookahead else 'index'
+        src('if %s < length:' % position)
+        with src:
+            src('%s = charbuffer[%s]' % (name, position))
+        src('elif buffer_is_final:')
+        with src:
+            if at_eof is None:
+                self.fail('Unexpected end of file')
+            else:
+                at_eof()
+                src('continue')
+        src('else:')
+        with src:
+            self.need_more()
+
+    def require_char(self, lookahead):
+        src = self.src
+        src('if index+%i >= length:' % lookahead)
+        with src:
+            src('if buffer_is_final:')
+            with src:
+                self.fail('Unexpected end of file')
+            self.need_more()
+
+    def skip(self, increment=1):
+        src = self.src
+        src('if start != index:')
+        with src:
+            src('prefix += charbuffer[start:index]')
+        src('index += %i' % increment,
+            'start = index')
+
+    def emit_at_eof(self):
+        if self.parser.strict:
+            return None
+        return lambda: self.src('state = %i' % EMIT)
+
+    def close_field(self, last_field, advance):
+        p = self.parser
+        src = self.src
+        if last_field:
+            src('if field_index != %i:' % (p.field_count-1))
+        else:
+            src('if field_index >= %i:' % (p.field_count-1))
+        with src:
+            self.fail("Can't close")
+        if p.selected_fields is not None:
+            # Fields that aren't selected or validated aren't sliced
+            src('if field_index not in SKIPPED:')
+            src.level += 1
+        src('if start == index:')
+        with src:
+            src('field = prefix')
+        src('elif prefix:')
+        with src:
+            src('field = prefix + charbuffer[start:index]')
+        src('else:')
+        with src:
+            src('field = charbuffer[start:index]')
+        if self.encoding is not None:
+            src('field = field.decode(%r)' % self.encoding)
+        if p.content_validation_rules:
+            src('rule = RULES.get(field_index)')
+            if p.cached_validation_fields:
+                # Results are kept by field and span, but only while there
+                # are alternatives: without any, this close won't be tried
+                # again
+                src('if rule is not None:')
+                with src:
+                    src('if alternatives and field_index in CACHED_RULES:')
+                    with src:
+                        src('key = (field_index, start, index, prefix)',
+                            'valid = results.get(key)',
+                            'if valid is None:')
+                        with src:
+                            src('valid = results[key] = bool(rule(field))')
+                    src('else:')
+                    with src:
+                        src('valid = rule(field)')
+                    src('if not valid:')
+                    with src:
+                        self.fail("Can't close")
+            else:
+                src('if rule is not None and not rule(field):')
+                with src:
+                    self.fail("Can't close")
+        if p.nullstrings:
+            src('if field in NULLSTRINGS:')
+            with src:
+                src('field = None')
+        if p.emptystrings:
+            src('%s field in EMPTYSTRINGS:' % ('elif' if p.nullstrings else 'if'))
+            with src:
+                src("field = u''")
+        if p.intern_caches:
+            src('%s field_index in INTERN:' % ('elif' if p.nullstrings or p.emptystrings else 'if'))
+            with src:
+                src('field = INTERN[field_index](field)')
+        src('record[field_index] = field')
+        if p.selected_fields is not None:
+            src.level -= 1
+        if last_field:
+            if p.selected_fields is not None:
+                src('return [%s], index+%i' % (', '.join('record[%i]' % i for i in p.selected_fields), advance))
+            else:
+                src('return record, index+%i' % advance)
+        else:
+            src('field_index += 1',
+                'index += %i' % advance,
+                'start = index',
+                'prefix = %r' % self.empty)
+
+    def push(self, state, index='index', start='start', prefix='prefix'):
+        self.src('alternatives.append((%i, %s, field_index, %s, %s))' % (state, index, start, prefix))
+
+    def scan(self, search, endpos=None):
+        # the fast path of Parser.save_ordinary()
+        src = self.src
+        if endpos is None:
+            src('m = %s(charbuffer, index)' % search,
+                'if m is None:')
+            with src:
+                src('index = length')
+        else:
+            src('m = %s(charbuffer, index, %s)' % (search, endpos),
+                'if m is None:')
+            with src:
+                src('index = min(%s, length)' % endpos)
+        src('else:')
+        with src:
+            src('index = m.start()')
+
+    def limits_setup(self):
+        p = self.parser
+        src = self.src
+        if p.max_transitions is not None or p.max_record_seconds is not None:
+            src('transitions = 0')
+        if p.max_record_seconds is not None:
+            src('deadline = TIME() + %r' % p.max_record_seconds)
+        if p.max_backtracks is not None:
+            src('backtracks = 0')
+
+    def limits_check(self):
+        p = self.parser
+        src = self.src
+        if p.max_transitions is not None or p.max_record_seconds is not None:
+            src('transitions += 1')
+        if p.max_transitions is not None:
+            src('if transitions > %i:' % p.max_transitions)
+            with src:
+                src("raise RecordLimitException('Too many state transitions', 'transitions', index)")
+        if p.max_record_seconds is not None:
+            # Checking the time is slow, so only do it now and then
+            src('if not transitions & 0xff and TIME() > deadline:')
+            with src:
+                src("raise RecordLimitException('Record took too long', 'seconds', index)")
+
+    ###########################################################################
+    # States
+
+    def start_field(self):
+        p = self.parser
+        src = self.src
+        src('elif state == %i:' % START_FIELD)
+        with src:
+            self.get_char('c', at_eof=self.emit_at_eof())
+            src('if c == %s:' % self.char(SPACE))
+            with src:
+                if p.skipinitialspace:
+                    self.skip()
+                else:
+                    src('index += 1')
+            if self.quoting:
+                src('elif c == %s:' % self.char(p.quotechar))
+                with src:
+                    self.opening_quote()
+            src('else:')
+            with src:
+                src('state = %i' % IN_UNQUOTED_FIELD)
+
+    def opening_quote(self):
+        # Fallbacks in reverse order of preference: minimal quoting, then
+        # quoting, then unclosed quoting, then no quoting
+        p = self.parser
+        src = self.src
+        self.push(IN_UNQUOTED_FIELD, index='index+1')
+        src('if start == index:')
+        with src:
+            src('quoted_prefix = prefix')
+        src('else:')
+        with src:
+            src('quoted_prefix = prefix + charbuffer[start:index]')
+        if p.unclosedquoting:
+            self.push(IN_UNCLOSED_QUOTED_FIELD, index='index+1', start='index+1', prefix='quoted_prefix')
+        if p.minimalquoting:
+            self.push(IN_QUOTED_FIELD, index='index+1', start='index+1', prefix='quoted_prefix')
+            src('index += 1',
+                'state = %i' % IN_MINIMALLY_QUOTED_FIELD)
+        else:
+            src('index += 1',
+                'start = index',
+                'prefix = quoted_prefix',
+                'state = %i' % IN_QUOTED_FIELD)
+
+    def in_unquoted_field(self):
+        p = self.parser
+        src = self.src
+        src('if state == %i:' % IN_UNQUOTED_FIELD)
+        with src:
+            self.scan('UNQUOTED_SEARCH')
+            self.get_char('c', at_eof=self.emit_at_eof())
+            src('if c == %s:' % self.char(p.delimiter))
+            with src:
+                if p.allow_unquoted_delimiters_in:
+                    # try saving the delimiter (greedy)
+                    src('if field_index in SPARE_DELIMITERS:')
+                    with src:
+                        self.push(CLOSING_DELIMITER)
+                        src('index += 1',
+                            'continue')
+                src('state = %i' % CLOSING_DELIMITER)
+            if p.escapechar is not None:
+                src('elif c == %s:' % self.char(p.escapechar))
+                with src:
+                    self.require_char(1)
+                    self.skip()
+                    src('index += 1')
+            src('elif c == %s:' % self.char(self.linebreak))
+            with src:
+                if p.newline == u'DOS':
+                    self.crlf_in_unquoted_field()
+                else:
+                    self.linebreak_in_unquoted_field(1)
+            src('else:')
+            with src:
+                src('index += 1')
+
+    def crlf_in_unquoted_field(self):
+        src = self.src
+        src('if index+1 < length:')
+        with src:
+            src('nextchar = charbuffer[index+1]')
+        src('elif buffer_is_final:')
+        with src:
+            # eof after CR, save CR and handle EOF
+            src('index += 1',
+                'continue')
+        src('else:')
+        with src:
+            self.need_more()
+        src('if nextchar == %s:' % self.char(LF))
+        with src:
+            self.linebreak_in_unquoted_field(2)
+        src('else:')
+        with src:
+            src('index += 1')
+
+    def linebreak_in_unquoted_field(self, length):
+        src = self.src
+        emit = {1: EMIT_AFTER_1, 2: EMIT_AFTER_2}[length]
+        if self.parser.allow_unquoted_linebreaks_in:
+            # line breaks immediately before eof never get saved
+            src('if field_index in SPARE_LINEBREAKS and (not buffer_is_final or index+%i < length):' % length)
+            with src:
+                # try saving the linebreak (greedy)
+                self.push(emit)
+                src('index += %i' % length,
+                    'continue')
+        src('state = %i' % emit)
+
+    def closing_delimiter(self):
+        src = self.src
+        src('elif state == %i:' % CLOSING_DELIMITER)
+        with src:
+            self.close_field(False, 1)
+            src('state = %i' % START_FIELD)
+
+    def in_quoted_field(self):
+        p = self.parser
+        src = self.src
+        src('elif state == %i:' % IN_QUOTED_FIELD)
+        with src:
+            # Don't scan further than the point where the field gets too long
+            src('endpos = start + %i - len(prefix)' % (p.max_field_length+1),
+                'if endpos > index:')
+            with src:
+                self.scan('QUOTED_SEARCH', 'endpos')
+            src('if index - start + len(prefix) > %i:' % p.max_field_length)
+            with src:
+                self.fail('Field too long')
+            self.get_char('c')
+            src('if c == %s:' % self.char(p.quotechar))
+            with src:
+                self.skip()
+                src('state = %i' % QUOTE_IN_QUOTED_FIELD)
+            if p.escapechar is not None:
+                src('elif c == %s:' % self.char(p.escapechar))
+                with src:
+                    self.require_char(1)
+                    self.skip()
+                    src('index += 1')
+            src('else:')
+            with src:
+                src('index += 1')
+
+    def quote_in_quoted_field(self):
+        p = self.parser
+        src = self.src
+        src('elif state == %i:' % QUOTE_IN_QUOTED_FIELD)
+        with src:
+            self.get_char('c', at_eof=self.emit_at_eof())
+            src('if c == %s:' % self.char(p.delimiter))
+            with src:
+                src('state = %i' % CLOSING_DELIMITER)
+            src('elif c == %s:' % self.char(p.quotechar))
+            with src:
+                if p.doublequote:
+                    src('index += 1',
+                        'state = %i' % IN_QUOTED_FIELD)
+                else:
+                    self.fail('Data after closing quote')
+            if p.newline == u'UNIX':
+                src('elif c == %s:' % self.char(LF))
+                with src:
+                    src('state = %i' % EMIT_AFTER_1)
+            src('elif c == %s:' % self.char(CR))
+            with src:
+                if p.newline == u'MAC':
+                    src('state = %i' % EMIT_AFTER_1)
+                elif p.newline == u'DOS':
+                    self.get_char('nextchar', 1)
+                    src('if nextchar != %s:' % self.char(LF))
+                    with src:
+                        self.fail('Failed to match %s' % (CR+LF))
+                    src('state = %i' % EMIT_AFTER_2)
+                else:
+                    src('index += 1',
+                        'state = %i' % IN_UNQUOTED_FIELD)
+            src('else:')
+            with src:
+                self.fail('Data after closing quote')
+
+    def in_unclosed_quoted_field(self):
+        # If we see EOF, we pretend it was preceded by a quote
+        p = self.parser
+        src = self.src
+        src('elif state == %i:' % IN_UNCLOSED_QUOTED_FIELD)
+        with src:
+            self.get_char('c', at_eof=lambda: src('state = %i' % QUOTE_IN_QUOTED_FIELD))
+            src('if c == %s:' % self.char(p.quotechar))
+            with src:
+                self.fail('Quote seen while trying to parse unclosed quoted field.')
+            src('elif c == %s or c == %s or c == %s:' % (self.char(LF), self.char(CR), self.char(p.delimiter)))
+            with src:
+                # Pretend we just saw a quote. If that fails, save and proceed
+                self.push(IN_UNCLOSED_QUOTED_FIELD, index='index+1')
+                src('state = %i' % QUOTE_IN_QUOTED_FIELD)
+            if p.escapechar is not None:
+                src('elif c == %s:' % self.char(p.escapechar))
+                with src:
+                    self.require_char(1)
+                    self.skip()
+                    src('index += 1')
+            src('else:')
+            with src:
+                src('index += 1')
+
+    def in_minimally_quoted_field(self):
+        p = self.parser
+        src = self.src
+        src('elif state == %i:' % IN_MINIMALLY_QUOTED_FIELD)
+        with src:
+            self.get_char('c')
+            special = [LF, CR, p.delimiter]
+            if p.escapechar is not None:
+                special.append(p.escapechar)
+            src('if %s:' % ' or '.join('c == %s' % self.char(s) for s in special))
+            with src:
+                self.fail('Non-minimal quoting')
+            src('index += 1')
+            src('if c == %s:' % self.char(p.quotechar))
+            with src:
+                src('state = %i' % QUOTE_IN_QUOTED_FIELD)
+
+    def fail_state(self):
+        src = self.src
+        src('elif state == %i:' % FAIL)
+        with src:
+            src('if not alternatives:')
+            with src:
+                src('raise BacktrackException(message, '
+                    '(charbuffer, index, buffer_is_final, record, field_index, start, prefix))')
+            if self.parser.max_backtracks is not None:
+                src('backtracks += 1',
+                    'if backtracks > %i:' % self.parser.max_backtracks)
+                with src:
+                    src("raise RecordLimitException('Too many backtracks', 'backtracks', index)")
+            src('state, index, field_index, start, prefix = alternatives.pop()')
+
+
+def bytes_search(pattern):
+    # The search method of pattern, for byte strings. The dialect
+    # characters are ASCII, see Parser.parse_bytes().
+    return re.compile(pattern.pattern.encode('ascii')).search
+
+
+def compile_rule(rule):
+    # Declarative rules (see delim.rules) may have a faster callable for
+    # generated code, whose result only has to be true or false
+    if hasattr(rule, 'compile'):
+        return rule.compile()
+    return rule
+
+
+def generate_parse(parser, encoding=None):
+    # Return a parse_record(charbuffer, startindex, buffer_is_final) function
+    # for the parser's current configuration, parsing bytes in encoding if
+    # one is given
+    parser.update_special_chars()
+    source = Generator(parser, encoding).generate()
+    if encoding is None:
+        unquoted_search = parser.unquoted_special_chars.search
+        quoted_search = parser.quoted_special_chars.search
+    else:
+        unquoted_search = bytes_search(parser.unquoted_special_chars)
+        quoted_search = bytes_search(parser.quoted_special_chars)
+    namespace = {
+        'BacktrackException': BacktrackException,
+        'RecordLimitException': RecordLimitException,
+        'TIME': time.time,
+        'UNQUOTED_SEARCH': unquoted_search,
+        'QUOTED_SEARCH': quoted_search,
+        'SPARE_DELIMITERS': frozenset(parser.allow_unquoted_delimiters_in),
+        'SPARE_LINEBREAKS': frozenset(parser.allow_unquoted_linebreaks_in),
+        'RULES': dict((i, compile_rule(rule)) for i, rule in parser.content_validation_rules.iteritems()),
+        'CACHED_RULES': frozenset(parser.cached_validation_fields),
+        'NULLSTRINGS': frozenset(parser.nullstrings),
+        'EMPTYSTRINGS': frozenset(parser.emptystrings),
+        'INTERN': dict(parser.intern_caches),
+        'SKIPPED': parser.skipped_fields - frozenset(parser.content_validation_rules),
+    }
+    exec compile(source, '<delim.codegen>', 'exec') in namespace
+    parse = namespace['parse']
+    parse.source = source
+    return parse
@@ -0,0 +1,208 @@
+import datetime
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Records parsed into per-column buffers, see Parser.parse_batch().
+#
+# Values that were nullstrings in the file are parsed as None, and are
+# marked in each column's null bitmap. Typed columns also treat empty
+# fields as null. Null entries in typed arrays hold 0.
+#
+# A column appends a value in two steps: prepare() converts it, raising
+# ValueError if it can't be stored, and store() adds what prepare()
+# returned. ColumnBatch prepares all of a record's values before storing
+# any, so a record that fails leaves the batch as it was.
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class Column(object):
+    def __init__(self, field_index):
+        self.field_index = field_index
+        self.null_indexes = []
+        self.nulls = None
+
+    def append(self, value):
+        self.store(self.prepare(value))
+
+    def finish(self, length):
+        # Build the null bitmap: bit i is set if value i is null
+        self.nulls = bytearray((length+7) // 8)
+        for i in self.null_indexes:
+            self.nulls[i >> 3] |= 1 << (i & 7)
+        del self.null_indexes
+
+    def is_null(self, i):
+        return bool(self.nulls[i >> 3] & (1 << (i & 7)))
+
+
+class StringColumn(Column):
+    # Stores all values in one string, with an array of offsets
+    def __init__(self, field_index):
+        Column.__init__(self, field_index)
+        self.values = []
+
+    def prepare(self, value):
+        return value
+
+    def store(self, value):
+        if value is None:
+            self.null_indexes.append(len(self.values))
+            value = u''
+        self.values.append(value)
+
+    def finish(self, length):
+        Column.finish(self, length)
+        self.offsets = array('l', [0])
+        offset = 0
+        for value in self.values:
+            offset += len(value)
+            self.offsets.append(offset)
+        self.text = u''.join(self.values)
+        del self.values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.is_null(i):
+            return None
+        return self.text[self.offsets[i]:self.offsets[i+1]]
+
+    def to_numpy(self):
+        return numpy.array([self[i] for i in range(len(self))], dtype=object)
+
+
+class ArrayColumn(Column):
+    typecode = None
+
+    def __init__(self, field_index):
+        Column.__init__(self, field_index)
+        self.values = array(self.typecode)
+        # Converted values are tried here first, for ints that don't fit
+        self.scratch = array(self.typecode, [0])
+
+    def prepare(self, value):
+        # None for a null value
+        if not value:
+            return None
+        try:
+            converted = self.convert(value)
+            self.scratch[0] = converted
+        except (ValueError, OverflowError):
+            raise ValueError("Can't convert %r in field %i" % (value, self.field_index))
+        return converted
+
+    def store(self, value):
+        if value is None:
+            self.null_indexes.append(len(self.values))
+            value = 0
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if self.is_null(i):
+            return None
+        return self.values[i]
+
+    def to_numpy(self):
+        values = numpy.frombuffer(self.values, dtype=self.values.typecode)
+        # unpackbits is big-endian within each byte
+        bits = numpy.unpackbits(numpy.frombuffer(bytes(self.nulls), dtype=numpy.uint8))
+        mask = bits.reshape(-1, 8)[:, ::-1].ravel()[:len(values)]
+        return numpy.ma.masked_array(values, mask.astype(bool))
+
+
+class IntColumn(ArrayColumn):
+    typecode = 'l'
+    convert = staticmethod(int)
+
+
+class FloatColumn(ArrayColumn):
+    typecode = 'd'
+    convert = staticmethod(float)
+
+
+class DateColumn(ArrayColumn):
+    # Dates are stored as proleptic Gregorian ordinals
+    typecode = 'l'
+
+    def __init__(self, field_index, format='%Y-%m-%d'):
+        ArrayColumn.__init__(self, field_index)
+        self.format = format
+
+    def convert(self, value):
+        return datetime.datetime.strptime(value, self.format).toordinal()
+
+    def __getitem__(self, i):
+        if self.is_null(i):
+            return None
+        return datetime.date.fromordinal(self.values[i])
+
+    def to_numpy(self):
+        days = ArrayColumn.to_numpy(self) - EPOCH_ORDINAL
+        return days.astype('datetime64[D]')
+
+
+COLUMN_TYPES = {
+    'str': StringColumn,
+    'int': IntColumn,
+    'float': FloatColumn,
+    'date': DateColumn,
+}
+
+
+def make_column(field_index, column_type):
+    # column_type is one of COLUMN_TYPES, or a ('date', format) pair
+    if isinstance(column_type, tuple):
+        column_type, args = column_type[0], column_type[1:]
+    else:
+        args = ()
+    return COLUMN_TYPES[column_type](field_index, *args)
+
+
+class ColumnBatch(object):
+    # field_indexes are the fields the columns hold, if the records only
+    # have some of them (see Parser.select_fields()). types is keyed by
+    # field index.
+    def __init__(self, field_count, size=1024, types=None, field_indexes=None):
+        types = types or {}
+        self.size = size
+        self.length = 0
+        if field_indexes is None:
+            field_indexes = range(field_count)
+        self.columns = [make_column(i, types.get(i, 'str')) for i in field_indexes]
+        self.preparers = [column.prepare for column in self.columns]
+        self.storers = [column.store for column in self.columns]
+
+    def append(self, record):
+        values = [prepare(value) for prepare, value in izip(self.preparers, record)]
+        for store, value in izip(self.storers, values):
+            store(value)
+        self.length += 1
+
+    def full(self):
+        return self.length >= self.size
+
+    def finish(self):
+        del self.preparers, self.storers
+        for column in self.columns:
+            column.finish(self.length)
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.columns[i]
+
+    def records(self):
+        for i in range(self.length):
+            yield tuple(column[i] for column in self.columns)
@@ -0,0 +1,256 @@
+import ctypes
+import ctypes.util
+import errno
+import io
+import os
+import select
+import struct
+import time
+import zlib
+
+from stream import RecordStream
+
+# Parse a file that's being appended to, like tail -f, see Follower.
+#
+# New bytes are fed to a RecordStream, so only they are parsed, and a
+# record that's still being written waits in the stream until its
+# linebreak arrives. Between reads the follower waits for the file to
+# change, with inotify where the C library has it and by sleeping for
+# poll_interval otherwise.
+#
+# A checkpoint is the byte offset read up to and the text after the last
+# record handed out, so a restarted follower carries on without reading
+# the file again. It's saved each time the records from a read have all
+# been handed out, so after a crash the records since the last save are
+# handed out again. Bytes of a character that hasn't been read completely
+# are left out of the offset, and read again.
+#
+# If the file is replaced or truncated, it's followed again from its
+# start. Since a new file can get the inode of a deleted one, checkpoints
+# also keep a CRC of the file's first bytes.
+
+MAGIC = b'DLMF'
+VERSION = 1
+HEADER = struct.Struct('<4sBxxxQQQI')
+# The most bytes the CRC in a checkpoint covers
+HEAD_SIZE = 1024
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVE_SELF = 0x800
+IN_DELETE_SELF = 0x400
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+WATCH_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+
+
+def load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+libc = load_libc()
+
+
+class PollWatch(object):
+    # Waits by sleeping
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+class InotifyWatch(object):
+    # Waits until path changes, or timeout seconds have passed
+    def __init__(self, path):
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, path, WATCH_EVENTS) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, "inotify_add_watch failed for %s" % path)
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            # The events themselves don't matter, only that there were some
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watch(path):
+    if libc is not None:
+        try:
+            return InotifyWatch(path)
+        except OSError:
+            pass
+    return PollWatch()
+
+
+def head_crc(f, length):
+    # The CRC of the first length bytes of f, which is left at its start
+    f.seek(0)
+    crc = zlib.crc32(f.read(length)) & 0xffffffff
+    f.seek(0)
+    return crc
+
+
+class Checkpoint(object):
+    # head_length is the number of bytes head_crc is the CRC of
+    def __init__(self, offset=0, pending=u'', inode=0, head_length=0, head_crc=0):
+        self.offset = offset
+        self.pending = pending
+        self.inode = inode
+        self.head_length = head_length
+        self.head_crc = head_crc
+
+    def matches(self, f):
+        # Whether the checkpoint can be for f
+        stat = os.fstat(f.fileno())
+        return (stat.st_ino == self.inode and stat.st_size >= self.offset and
+                head_crc(f, self.head_length) == self.head_crc)
+
+    def save(self, path):
+        # Write to a temporary file first, so an interrupted save leaves the
+        # previous checkpoint in place
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.offset, self.inode, self.head_length, self.head_crc))
+            f.write(self.pending.encode('utf-8'))
+        os.rename(temp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, offset, inode, head_length, crc = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s isn't a follow checkpoint" % path)
+        return cls(offset, data[HEADER.size:].decode('utf-8'), inode, head_length, crc)
+
+
+class Follower(object):
+    # Follow the file at path with parser. With checkpoint_path, start from
+    # the checkpoint saved there, if there is one, and keep saving it.
+    def __init__(self, path, parser, encoding='utf-8', checkpoint_path=None,
+                 poll_interval=1.0, chunk_size=65536):
+        self.path = path
+        self.parser = parser
+        self.encoding = encoding
+        self.checkpoint_path = checkpoint_path
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self.start = Checkpoint.load(checkpoint_path)
+        else:
+            self.start = Checkpoint()
+        self.stream = None
+        self.offset = None
+        self.inode = None
+        self.head_length = None
+        self.head_crc = None
+
+    def checkpoint(self):
+        # The checkpoint after the records handed out so far
+        if self.stream is None:
+            return self.start
+        stream = self.stream
+        buffered, flags = stream.decoder.getstate()
+        return Checkpoint(self.offset - len(buffered), stream.unparsed(), self.inode,
+                          self.head_length, self.head_crc)
+
+    def save_checkpoint(self):
+        if self.checkpoint_path is not None:
+            self.checkpoint().save(self.checkpoint_path)
+
+    def restart(self, f, checkpoint):
+        # Start parsing f from checkpoint
+        if not checkpoint.matches(f):
+            checkpoint = Checkpoint()
+        self.inode = os.fstat(f.fileno()).st_ino
+        self.head_length = checkpoint.head_length
+        self.head_crc = checkpoint.head_crc
+        self.stream = RecordStream(self.parser, self.encoding)
+        if checkpoint.pending:
+            self.stream.feed(checkpoint.pending)
+        f.seek(checkpoint.offset)
+        self.offset = checkpoint.offset
+
+    def read(self, f):
+        data = f.read(self.chunk_size)
+        # Extend the CRC of the first bytes. After a restart, data can
+        # start with bytes that it already covers.
+        start = self.head_length - self.offset
+        if self.head_length < HEAD_SIZE and 0 <= start < len(data):
+            more = data[start:start + HEAD_SIZE - self.head_length]
+            self.head_crc = zlib.crc32(more, self.head_crc) & 0xffffffff
+            self.head_length += len(more)
+        self.offset += len(data)
+        return data
+
+    def replaced(self, f):
+        # Whether the file at path isn't f any more, or was truncated
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return False
+        stat = os.fstat(f.fileno())
+        return inode != self.inode or stat.st_nlink == 0 or stat.st_size < self.offset
+
+    def records(self, idle_timeout=None):
+        # Yield records as they're appended, stopping once nothing has been
+        # appended for idle_timeout seconds (never by default). A record
+        # that's still unfinished then stays in the checkpoint.
+        idle_since = time.time()
+        while True:
+            # io doesn't stop reading at the first end of file like stdio can
+            f = io.open(self.path, 'rb')
+            watch = make_watch(self.path)
+            try:
+                self.restart(f, self.checkpoint())
+                while True:
+                    data = self.read(f)
+                    if data:
+                        idle_since = time.time()
+                        self.stream.feed(data)
+                        # One at a time, so checkpoint() is always after
+                        # the last record handed out
+                        records = self.stream.parse_available(1)
+                        if records:
+                            while records:
+                                yield records[0]
+                                records = self.stream.parse_available(1)
+                            self.save_checkpoint()
+                        continue
+                    if self.replaced(f):
+                        break
+                    if idle_timeout is not None and time.time() - idle_since >= idle_timeout:
+                        return
+                    watch.wait(self.poll_interval)
+            finally:
+                watch.close()
+                f.close()
+            # Follow the new file from its start
+            self.start = Checkpoint()
+            self.stream = None
+
+    def __iter__(self):
+        return self.records()
+
+
+def follow(path, parser, encoding='utf-8', checkpoint_path=None, poll_interval=1.0, idle_timeout=None):
+    # Iterate over the records appended to path, see Follower
+    return Follower(path, parser, encoding, checkpoint_path, poll_interval).records(idle_timeout)
@@ -0,0 +1,93 @@
+import bisect
+import os
+import struct
+import sys
+from array import array
+
+# Byte offsets of record starts, for random access and resuming, see
+# Parser.iter_records(), Parser.seek_record() and Parser.resume_records().
+#
+# Only every `every`th record start is kept: offsets[k] is where record
+# k*every starts. Reaching any other record means parsing at most
+# every-1 records from the one before it. records is the number of records
+# parsed so far, so a load that saves the index after handling each record
+# can resume after the last one it saved.
+#
+# Offsets are counted by encoding the parsed text again, so they're exact
+# as long as that gives back the bytes in the file, which holds for
+# well-formed input in the usual encodings.
+#
+# The side file is a header followed by the offsets as 8 byte little
+# endian integers, so like the columns in delim.columns this assumes a C
+# long is 8 bytes.
+
+MAGIC = b'DLMX'
+VERSION = 1
+HEADER = struct.Struct('<4sBxxxQQ')
+
+
+class RecordIndex(object):
+    def __init__(self, every=1):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        self.every = every
+        self.records = 0
+        self.offsets = array('l')
+
+    def wants(self, record_number):
+        return record_number % self.every == 0
+
+    def lookup(self, n):
+        # Return (record number, byte offset) of the closest indexed
+        # record at or before record n
+        if n < 0 or n > self.records:
+            raise IndexError("Record %i isn't in the index" % n)
+        k = min(n // self.every, len(self.offsets) - 1)
+        if k < 0:
+            return 0, 0
+        return k * self.every, self.offsets[k]
+
+    def truncate(self, n):
+        # Forget records from the closest indexed one at or before record n
+        # on, so they can be indexed again. Returns (record number, byte
+        # offset) of where parsing has to start again.
+        record_number, offset = self.lookup(n)
+        del self.offsets[record_number // self.every:]
+        self.records = record_number
+        return record_number, offset
+
+    def offset_at_or_after(self, offset):
+        # The first indexed record start at or after offset, or None
+        k = bisect.bisect_left(self.offsets, offset)
+        if k == len(self.offsets):
+            return None
+        return self.offsets[k]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def save(self, path):
+        # Write to a temporary file first, so an interrupted save leaves the
+        # previous index in place
+        temp = path + '.tmp'
+        offsets = array('l', self.offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        with open(temp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.every, self.records))
+            f.write(offsets.tostring())
+        os.rename(temp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, version, every, records = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s isn't a record index" % path)
+        index = cls(every)
+        index.records = records
+        index.offsets.fromstring(data[HEADER.size:])
+        if sys.byteorder == 'big':
+            index.offsets.byteswap()
+        return index
@@ -0,0 +1,66 @@
+# Sharing of repeated field values, see Parser.intern_field().
+#
+# A column with a few distinct values (statuses, country codes) otherwise
+# gets a new string per record. An InternCache returns the first string it
+# saw with each value instead, so the records and ColumnBatches that hold
+# them share one string per value.
+#
+# To keep a hit down to one dict lookup, least recently used values are
+# evicted a generation at a time: values go into recent, and when recent
+# has max_size values it replaces older, which is dropped. A hit in older
+# moves the value back into recent. So values used since the last
+# max_size new ones are always kept, and the cache holds at most twice
+# max_size values, up to max_size in each generation.
+#
+# Interning only pays for columns with few distinct values, so every
+# `window` lookups the cache checks how many of them missed, and switches
+# itself off for good if more than max_miss_rate did.
+
+
+class InternCache(object):
+    def __init__(self, max_size=1024, max_miss_rate=0.2, window=10000):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.max_miss_rate = max_miss_rate
+        self.window = window
+        self.enabled = True
+        self.recent = {}
+        self.older = {}
+        # Counts for the current window
+        self.lookups = 0
+        self.misses = 0
+
+    def __call__(self, value):
+        if not self.enabled:
+            return value
+        self.lookups += 1
+        shared = self.recent.get(value)
+        if shared is None:
+            return self.miss(value)
+        return shared
+
+    def miss(self, value):
+        if self.lookups >= self.window:
+            if self.misses > self.max_miss_rate * self.lookups:
+                self.disable()
+                return value
+            self.lookups = 1
+            self.misses = 0
+        shared = self.older.pop(value, None)
+        if shared is None:
+            self.misses += 1
+            shared = value
+        if len(self.recent) >= self.max_size:
+            self.older = self.recent
+            self.recent = {}
+        self.recent[shared] = shared
+        return shared
+
+    def disable(self):
+        self.enabled = False
+        self.recent = {}
+        self.older = {}
+
+    def __len__(self):
+        return len(self.recent) + len(self.older)
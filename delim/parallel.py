@@ -0,0 +1,161 @@
+import bisect
+import codecs
+import multiprocessing
+import os
+from itertools import izip
+
+from parser import BacktrackException, RecordLimitException
+
+# Parse a file in byte ranges on a pool of worker processes.
+#
+# Each range starts right after the first record linebreak at or after an
+# evenly spaced offset. That is usually, but not always, the start of a
+# record: the linebreak may be quoted, escaped or a spare linebreak in a
+# field. Each worker parses the records that start within its range,
+# reading past the end of the range to finish the last one, and reports
+# where every record started and how far into the next range the last one
+# ended.
+#
+# Parsing is deterministic from a given record start, so if the previous
+# range's last record ended at one of the record starts a worker found,
+# the worker's records from there on are the ones a sequential parse would
+# have produced. Otherwise the range is parsed again from the right place
+# in this process.
+#
+# Each worker gets the parser once, when the pool starts, and compiles it
+# (see Parser.compile()) unless it memoizes failures or collects stats,
+# which the compiled function doesn't do. Results are reconciled as each
+# range finishes, so records are yielded while later ranges are parsed.
+#
+# Only ASCII compatible encodings are supported, since linebreaks are
+# searched for as bytes.
+
+READ_SIZE = 65536
+
+LINEBREAKS = {
+    u'UNIX': b'\n',
+    u'MAC': b'\r',
+    u'DOS': b'\r\n',
+}
+
+
+def find_record_start(f, offset, linebreak):
+    # Return the offset just after the first linebreak at or after offset,
+    # or the end of the file
+    if offset == 0:
+        return 0
+    f.seek(offset)
+    data = b''
+    while True:
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            return offset + len(data)
+        data += chunk
+        i = data.find(linebreak)
+        if i >= 0:
+            return offset + i + len(linebreak)
+        # keep the last byte, in case a CRLF is split between reads
+        offset += len(data) - 1
+        data = data[-1:]
+
+
+def split_file(path, parser, ranges, record_index=None):
+    # Ranges start at record starts from record_index (see delim.index)
+    # where it has them, so their seams are always good
+    size = os.path.getsize(path)
+    linebreak = LINEBREAKS[parser.newline]
+    starts = []
+    with open(path, 'rb') as f:
+        for i in range(ranges):
+            start = None
+            if record_index is not None:
+                start = record_index.offset_at_or_after(size * i // ranges)
+            if start is None:
+                start = find_record_start(f, size * i // ranges, linebreak)
+            if not starts or start > starts[-1]:
+                starts.append(start)
+    return zip(starts, starts[1:] + [size])
+
+
+def parse_range(path, parser, encoding, start, stop, skip=0):
+    # Parse the records that start within the bytes [start, stop) of path,
+    # from the character skip onwards. Returns the records, the character
+    # offsets they started at, the number of characters in the range and
+    # how many characters past the range the last record ended.
+    with open(path, 'rb') as f:
+        f.seek(start)
+        charbuffer = f.read(stop-start).decode(encoding)
+        length = len(charbuffer)
+        decoder = codecs.getincrementaldecoder(encoding)()
+        buffer_is_final = False
+        records = []
+        starts = []
+        index = skip
+        while index < length:
+            try:
+                record, end = parser.parse(charbuffer, index, buffer_is_final)
+            except IndexError:
+                if buffer_is_final:
+                    raise
+                data = f.read(READ_SIZE)
+                charbuffer += decoder.decode(data, not data)
+                buffer_is_final = not data
+                continue
+            records.append(record)
+            starts.append(index)
+            index = end
+    return records, starts, length, index-length
+
+
+# The parser of a worker process, see init_worker()
+worker_parser = None
+
+
+def init_worker(parser):
+    global worker_parser
+    if not parser.memoize_failures and parser.stats is None:
+        parser.compile()
+    worker_parser = parser
+
+
+def parse_range_in_worker(args):
+    # A failure may just mean the range didn't start on a record, so it
+    # is left to the caller to parse the range again. That includes
+    # running into the parser's limits, which a misaligned start can.
+    path, encoding, start, stop = args
+    try:
+        return parse_range(path, worker_parser, encoding, start, stop)
+    except (BacktrackException, RecordLimitException):
+        return None
+
+
+def parse_file_parallel(path, parser, workers=None, encoding='utf-8', ranges_per_worker=4, record_index=None):
+    # Yield the records in path in order, parsed by a pool of workers
+    workers = workers or multiprocessing.cpu_count()
+    ranges = split_file(path, parser, workers * ranges_per_worker, record_index)
+    pool = multiprocessing.Pool(workers, init_worker, (parser,))
+    try:
+        results = pool.imap(parse_range_in_worker,
+            [(path, encoding, start, stop) for start, stop in ranges])
+        # how far into the current range the previous record ended
+        skip = 0
+        for (start, stop), result in izip(ranges, results):
+            if result is not None:
+                records, starts, length, overflow = result
+                if skip >= length:
+                    skip -= length
+                    continue
+                i = bisect.bisect_left(starts, skip)
+                if i < len(starts) and starts[i] == skip:
+                    for record in records[i:]:
+                        yield record
+                    skip = overflow
+                    continue
+            # Bad seam, so parse the range again from where the previous
+            # record ended. This raises if the file really is malformed.
+            records, starts, length, overflow = parse_range(path, parser, encoding, start, stop, skip)
+            for record in records:
+                yield record
+            skip = overflow
+    finally:
+        pool.terminate()
@@ -1,20 +1,78 @@
+import codecs
+import itertools
 import logging 
+import mmap
+import os
+import re
+import time
 import unicodedata
 
 from util import *
+from columns import ColumnBatch
+from stats import ParseStats
+from intern import InternCache
 
 CR = u'\r'
 LF = u'\n'
 SPACE = u' '
 
+LINEBREAKS = {
+    u'UNIX': LF,
+    u'MAC': CR,
+    u'DOS': CR+LF,
+}
+
+# States that are past any quoting of the current field
+UNQUOTED_STATES = frozenset([
+    'in_unquoted_field',
+    'delimiter_in_unquoted_field',
+    'closing_delimiter',
+    'single_char_linebreak_in_unquoted_field',
+    'cr_in_unquoted_field',
+    'emit'])
+
+# Returned by states in place of the next state. A failing state returns
+# FAILED with (message, params), and a state that needs more data than the
+# buffer holds returns NEED_MORE. Only when there's no alternative left
+# does the engine raise BacktrackException or IndexError. Both are false,
+# like emit's None, so the engine loop only has to test the state once per
+# transition.
+class Signal(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __nonzero__(self):
+        return False
+
+    def __repr__(self):
+        return self.name
+
+FAILED = Signal('FAILED')
+NEED_MORE = Signal('NEED_MORE')
+
+# Attributes that change while parsing, rather than configure the parser
+RUNTIME_ATTRIBUTES = frozenset([
+    'compiled',
+    'compiled_bytes',
+    'log',
+    'pruned_states',
+    'stats',
+    'validation_results',
+    'special_chars_key',
+    'unquoted_special_chars',
+    'quoted_special_chars'])
+
 
 def mutator(f):
     return f
 
+# The names of all states, in definition order
+STATES = []
+
 def handler(f):
-    def _f(self, params):
-        print f.__name__, params
-        return f(self, params)
+    # Marks f as a state. States aren't wrapped: when stats are being
+    # collected, run_checked() counts them as it steps through them.
+    STATES.append(f.__name__)
     return f
 
 logging.basicConfig()
@@ -22,11 +80,26 @@ logging.basicConfig()
 class BacktrackException(Exception):
     def __init__(self, message, params):
         Exception.__init__(self, message)
+        self.params = params
         (self.charbuffer,
          self.index,
-         self.buffer_is_final,
-         self.record,
-         self.field) = params
+         self.buffer_is_final) = params[:3]
+
+    # Exceptions are pickled with their args, which only hold the message
+    def __reduce__(self):
+        return type(self), (self.message, self.params)
+
+    # The partial record and field are only needed for reporting, so
+    # they aren't sliced out of the charbuffer until someone asks
+
+    @property
+    def record(self):
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = self.params
+        return tuple(record[:field_index])
+
+    @property
+    def field(self):
+        return get_field(self.params)
 
     def __str__(self):
         try:
@@ -36,6 +109,40 @@ class BacktrackException(Exception):
         return "%s (%i+'%s': '%s')" % (self.message, len(self.record), format_string(self.field), format_char(c))
 
 
+def compile_char_class(chars):
+    chars = u''.join(re.escape(c) for c in set(chars) if c is not None)
+    if not chars:
+        # never matches
+        return re.compile(u'(?!)')
+    return re.compile(u'[%s]' % chars, re.UNICODE)
+
+
+def get_field(params):
+    # The current field is prefix + charbuffer[start:index]. prefix only
+    # holds text when skipped characters (escapes, doubled quotes) split
+    # the field into more than one span.
+    charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+    if start == index:
+        return prefix
+    elif prefix:
+        return prefix + charbuffer[start:index]
+    else:
+        return charbuffer[start:index]
+
+
+class RecordLimitException(Exception):
+    # Raised when parsing a record takes more work than the parser's
+    # limits allow. Unlike BacktrackException, this isn't backtracked
+    # over, and only the offset is kept.
+    def __init__(self, message, limit, index):
+        Exception.__init__(self, message)
+        self.limit = limit
+        self.index = index
+
+    def __reduce__(self):
+        return type(self), (self.message, self.limit, self.index)
+
+
 class Parser(object):
     def __init__(self, field_count, delimiter, newline, **kwargs):
         self.log = logging.getLogger(__name__)
@@ -57,14 +164,76 @@ class Parser(object):
         self.strict = False
         self.escapechar = None
         self.content_validation_rules = dict()
+        # Fields whose validators' results are kept for the current record,
+        # see validate_cached()
+        self.cached_validation_fields = set()
+        self.validation_results = {}
 
         self.max_field_length = 1000
 
+        # See select_fields()
+        self.selected_fields = None
+        self.skipped_fields = frozenset()
+
+        # InternCaches by field index, see intern_field()
+        self.intern_caches = {}
+
+        # Remember which states failed within a record, so ambiguous
+        # dialects don't explore them again. See run_checked().
+        self.memoize_failures = False
+        self.pruned_states = 0
+
+        # Limits on the work spent on a single record, see run_checked().
+        # None means no limit.
+        self.max_backtracks = None
+        self.max_transitions = None
+        self.max_record_seconds = None
+
+        # A ParseStats, see collect_stats()
+        self.stats = None
+
+        self.special_chars_key = None
+
+        # See compile() and parse_bytes()
+        self.compiled = None
+        self.compiled_bytes = {}
+
+    def __setattr__(self, name, value):
+        # Changing the configuration invalidates the compiled parse
+        # functions, and so does throwing away the one for unicode
+        if name not in RUNTIME_ATTRIBUTES or (name == 'compiled' and value is None):
+            self.__dict__['compiled'] = None
+            self.__dict__['compiled_bytes'] = {}
+        object.__setattr__(self, name, value)
+
+    # Parsers are pickled to hand them to worker processes (see
+    # delim.parallel), so validation rules have to be picklable too
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['log']
+        state['compiled'] = None
+        state['compiled_bytes'] = {}
+        state['validation_results'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = logging.getLogger(__name__)
+
     def add_validation_rules(self, field_index, rule):
+        # rule is called with the text of field field_index, and returns
+        # whether the field can be closed there. See delim.rules for
+        # declarative rules.
         field_index = int(field_index)
         if field_index in self.content_validation_rules:
             self.log.warn("Overwriting validation rule for field %i", field_index)
         self.content_validation_rules[field_index] = rule
+        if getattr(rule, 'cache_results', False):
+            self.cached_validation_fields.add(field_index)
+        else:
+            self.cached_validation_fields.discard(field_index)
+        self.compiled = None
 
     def set_delimiter(self, delimiter):
         self.delimiter = get_named_char(delimiter) or unicode(delimiter)
@@ -95,9 +264,11 @@ class Parser(object):
 
     def add_nullstring(self, nullstring):
         self.nullstrings.add(unicode(nullstring))
+        self.compiled = None
 
     def add_emptystring(self, emptystring):
         self.emptystrings.add(unicode(emptystring))
+        self.compiled = None
 
     def set_escapechar(self, escapechar):
         self.escapechar = get_named_char(escapechar) or unicode(escapechar)
@@ -106,9 +277,34 @@ class Parser(object):
 
     def allow_unquoted_delimiters_in_field(self, i):
         self.allow_unquoted_delimiters_in.add(i)
+        self.compiled = None
 
     def allow_unquoted_linebreaks_in_field(self, i):
         self.allow_unquoted_linebreaks_in.add(i)
+        self.compiled = None
+
+    def intern_field(self, i, max_size=1024, max_miss_rate=0.2):
+        # Share one string per distinct value of field i between records,
+        # for columns with few distinct values. See delim.intern.
+        self.intern_caches[i] = InternCache(max_size, max_miss_rate)
+        self.compiled = None
+
+    def select_fields(self, field_indexes):
+        # Only return the fields in field_indexes, in that order, or all of
+        # them if it's None. The other fields are still parsed, but they
+        # aren't sliced out of the buffer or checked against nullstrings
+        # and emptystrings. Fields with validation rules are still
+        # validated, since that can change how the record is parsed.
+        if field_indexes is None:
+            self.selected_fields = None
+            self.skipped_fields = frozenset()
+            return
+        field_indexes = tuple(int(i) for i in field_indexes)
+        for i in field_indexes:
+            if not 0 <= i < self.field_count:
+                raise MetadataException("Selected field %i isn't one of the %i fields" % (i, self.field_count))
+        self.selected_fields = field_indexes
+        self.skipped_fields = frozenset(range(self.field_count)) - frozenset(field_indexes)
 
 
 
@@ -117,96 +313,217 @@ class Parser(object):
 
     # Mutators
     # Return params, but changed
+    #
+    # params are (charbuffer, index, buffer_is_final, record, field_index, start, prefix).
+    # record is a list with a slot per field, of which the first field_index
+    # have been closed. Slots past field_index may hold leftovers from paths
+    # that were backtracked, but they are always overwritten before an emit.
+    # The current field is tracked as a span, see get_field().
 
     @mutator
-    def save(self, params, c):
-        charbuffer, index, buffer_is_final, record, field = params
-
-        return charbuffer, index+1, buffer_is_final, record, field+c
+    def save(self, params, length=1):
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+        return charbuffer, index+length, buffer_is_final, record, field_index, start, prefix
 
     @mutator
     def skip(self, params, increment=1):
-        charbuffer, index, buffer_is_final, record, field = params
-        return charbuffer, index+increment, buffer_is_final, record, field
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+        if start == index:
+            return charbuffer, index+increment, buffer_is_final, record, field_index, index+increment, prefix
+        # splice the span saved so far onto prefix and start a new one
+        return (charbuffer, index+increment, buffer_is_final, record, field_index,
+                index+increment, prefix + charbuffer[start:index])
 
     @mutator
     def close_field(self, params, last_field=False):
-        if not self.can_close_field(params, last_field):
-            raise BacktrackException("Can't close", params)
-
-        charbuffer, index, buffer_is_final, record, field = params
+        # Returns None if the field can't be closed
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+        if field_index in self.skipped_fields and field_index not in self.content_validation_rules:
+            # Not selected, so the field itself isn't needed
+            if not self.can_close_field(params, None, last_field):
+                return None
+            return (charbuffer, index, buffer_is_final, record, field_index+1, index, u'')
+
+        field = get_field(params)
+        if not self.can_close_field(params, field, last_field):
+            return None
 
         if field in self.nullstrings:
-            return (charbuffer, index, buffer_is_final, record+(None,), u'')
+            record[field_index] = None
         elif field in self.emptystrings:
-            return (charbuffer, index, buffer_is_final, record+(u'',), u'')
+            record[field_index] = u''
+        elif self.intern_caches and field_index in self.intern_caches:
+            record[field_index] = self.intern_caches[field_index](field)
         else:
-            return (charbuffer, index, buffer_is_final, record+(field,), u'')
-
-    @mutator
-    def match_string(self, params, s):
-        charbuffer, index, buffer_is_final, record, field = params
-        for c in s:
-            if c != self.get_char(params):
-                raise BacktrackException("Failed to match %s" % s, params)
-            params = self.skip(params)
-        return params
+            record[field_index] = field
+        return (charbuffer, index, buffer_is_final, record, field_index+1, index, u'')
 
-    def can_close_field(self, params, last_field=False):
-        charbuffer, index, buffer_is_final, record, field = params
-        field_index =len(record)
-        field = field
+    def can_close_field(self, params, field, last_field=False):
+        field_index = params[4]
         if field_index in self.content_validation_rules:
             validator = self.content_validation_rules[field_index]
-            is_valid = validator(field)
+            if field_index in self.cached_validation_fields:
+                is_valid = self.validate_cached(validator, params, field)
+            else:
+                is_valid = validator(field)
         else:
             is_valid = True
         if last_field:
-            return is_valid and len(record)+1 == self.field_count
+            return is_valid and field_index+1 == self.field_count
         else:
-            return is_valid and len(record)+1 < self.field_count
+            return is_valid and field_index+1 < self.field_count
+
+    def validate_cached(self, validator, params, field):
+        # A close can be tried again after backtracking, so the results of
+        # costly validators are kept by field and span for the record
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+        key = (field_index, start, index, prefix)
+        is_valid = self.validation_results.get(key)
+        if is_valid is None:
+            is_valid = self.validation_results[key] = bool(validator(field))
+        return is_valid
 
     def can_save_unquoted_delimiter(self, params):
-        charbuffer, index, buffer_is_final, record, field = params
-        return len(record) in self.allow_unquoted_delimiters_in
+        return params[4] in self.allow_unquoted_delimiters_in
 
     def can_save_unquoted_linebreak(self, params):
-        charbuffer, index, buffer_is_final, record, field = params
-        return len(record) in self.allow_unquoted_linebreaks_in
+        return params[4] in self.allow_unquoted_linebreaks_in
 
     def at_eof(self, params, lookahead=0):
-        charbuffer, index, buffer_is_final, record, field = params
+        charbuffer, index, buffer_is_final = params[:3]
         if not buffer_is_final:
             return False
-        try:
-            charbuffer[index+lookahead]
-        except IndexError:
-            return True
-        return False 
+        return index+lookahead >= len(charbuffer)
 
     def get_char(self, params, lookahead=0):
-        charbuffer, index, buffer_is_final, record, field = params
-        try:
+        # Returns None past the end of the buffer, see end_of_buffer()
+        charbuffer, index = params[:2]
+        if index+lookahead < len(charbuffer):
             return charbuffer[index+lookahead]
-        except IndexError:
-            if buffer_is_final:
-                raise BacktrackException("Unexpected end of file", params)
-            else:
-                raise
-
-    def check_field_length(self, params):
-        charbuffer, index, buffer_is_final, record, field = params
-        if len(field) > self.max_field_length:
-            raise BacktrackException("Field too long", params)
+        return None
+
+    def fail(self, message, params):
+        return FAILED, (message, params)
+
+    def end_of_buffer(self, params):
+        # For states that can't handle running out of characters
+        if params[2]:
+            return self.fail("Unexpected end of file", params)
+        return NEED_MORE, params
+
+    def save_ordinary(self, params, special_chars, endpos=None):
+        # Save the run of characters before the next one that special_chars
+        # matches (or before endpos), so the states only need to look at
+        # characters that can end or change the field
+        charbuffer, index = params[:2]
+        if endpos is None or endpos > len(charbuffer):
+            endpos = len(charbuffer)
+        elif endpos < index:
+            endpos = index
+        m = special_chars.search(charbuffer, index, endpos)
+        if m is None:
+            return self.save(params, endpos-index)
+        return self.save(params, m.start()-index)
+
+    def update_special_chars(self):
+        # Compile the character classes save_ordinary() scans for. The
+        # dialect attributes may be assigned directly, so check them on
+        # every parse rather than relying on the setters.
+        key = (self.delimiter, self.quotechar, self.escapechar, self.newline)
+        if key == self.special_chars_key:
+            return
+        linebreak = {u'UNIX': LF, u'MAC': CR, u'DOS': CR}[self.newline]
+        unquoted = [self.delimiter, linebreak, self.escapechar]
+        quoted = [self.quotechar, self.escapechar]
+        self.unquoted_special_chars = compile_char_class(unquoted)
+        self.quoted_special_chars = compile_char_class(quoted)
+        self.special_chars_key = key
+
+    def field_too_long(self, params):
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+        return index - start + len(prefix) > self.max_field_length
 
 
     ###########################################################################
     #
 
+    def compile(self):
+        # Generate a parse function specialized for the current
+        # configuration, see delim.codegen. parse_record() uses it until the
+        # configuration changes, then falls back to run() until compile()
+        # is called again. Memoizing failures and collecting stats need
+        # run_checked(), so the compiled function isn't used while either
+        # is switched on.
+        import codegen
+        self.compiled = codegen.generate_parse(self)
+        return self.compiled
+
     def parse(self, charbuffer, startindex=0, buffer_is_final=True):
+        record, index = self.parse_record(charbuffer, startindex, buffer_is_final)
+        return tuple(record), index
+
+    def parse_bytes(self, buffer, startindex=0, buffer_is_final=True, encoding='utf-8'):
+        # Like parse(), but for a str, buffer or mmap in an ASCII compatible
+        # encoding. The dialect characters are matched as bytes and only
+        # the fields that are returned get decoded, so a mapped file is
+        # never decoded (or read into memory) as a whole. startindex and
+        # the returned index are byte offsets.
+        #
+        # This always uses a parse function generated for the encoding
+        # (see compile()), so memoize_failures and stats don't apply.
+        parse_record = self.compiled_bytes.get(encoding)
+        if parse_record is None:
+            self.check_ascii_compatible(encoding)
+            import codegen
+            parse_record = codegen.generate_parse(self, encoding)
+            self.compiled_bytes[encoding] = parse_record
+        record, index = parse_record(buffer, startindex, buffer_is_final)
+        return tuple(record), index
+
+    def check_ascii_compatible(self, encoding):
+        # Bytes that encode the dialect characters mustn't turn up inside
+        # other characters, as they can in e.g. Shift JIS or UTF-16
+        name = codecs.lookup(encoding).name
+        if not (name in ('ascii', 'utf-8') or name.startswith('iso8859-') or name.startswith('cp125')):
+            raise MetadataException("Can't parse bytes in %s, which isn't ASCII compatible" % encoding)
+        for c in (self.delimiter, self.quotechar, self.escapechar):
+            if c is not None and ord(c) >= 0x80:
+                raise MetadataException("Can't parse bytes with the non-ASCII dialect character %r" % c)
+
+    def iter_mmap_records(self, path, encoding='utf-8'):
+        # Like iter_records(), but maps the file into memory and parses it
+        # with parse_bytes()
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            index = 0
+            length = len(buffer)
+            while index < length:
+                record, index = self.parse_bytes(buffer, index, True, encoding)
+                yield record
+        finally:
+            buffer.close()
+
+    def collect_stats(self, callback=None):
+        # Start counting state entries, backtracks and time per record
+        # into a new ParseStats, which is returned. Set stats to None to
+        # stop. While stats are collected, every record goes through
+        # run_checked(), so this isn't free; otherwise it costs nothing.
+        self.stats = ParseStats(STATES, callback)
+        return self.stats
+
+    def parse_record(self, charbuffer, startindex=0, buffer_is_final=True):
+        # Like parse(), but the record is returned as a list
+        if self.compiled is not None and not self.memoize_failures and self.stats is None:
+            return self.compiled(charbuffer, startindex, buffer_is_final)
         # try:
-        params = (charbuffer, startindex, buffer_is_final, (), u'')
-        return self.start_field(params)
+        self.update_special_chars()
+        if self.cached_validation_fields:
+            self.validation_results.clear()
+        params = (charbuffer, startindex, buffer_is_final, [None]*self.field_count, 0, startindex, u'')
+        return self.run(self.start_field, params)
         # except BacktrackException, e:
             # start_context = max(startindex, e.index-30)
             # end_context = min(len(charbuffer), e.index+5)
@@ -225,241 +542,519 @@ class Parser(object):
             #     print "%s: '%s' (%i)" % (func, txt, l)
             # raise
 
-    @handler
-    def start_field(self, params):
+    def run(self, state, params):
+        # States don't call each other: each one returns the next
+        # (state, params) pair, and emit returns None as its state.
+        # Where a state has more than one way forward, it pushes the
+        # fallback onto alternatives before returning the preferred one,
+        # and a failure (FAILED) resumes the most recent fallback.
+        # The Python stack depth is therefore independent of the record.
+        if (self.memoize_failures or self.stats is not None or self.max_backtracks is not None or
+            self.max_transitions is not None or self.max_record_seconds is not None):
+            return self.run_checked(state, params)
+        alternatives = []
+        while True:
+            while state:
+                state, params = state(params, alternatives)
+            if state is FAILED:
+                if not alternatives:
+                    raise BacktrackException(*params)
+                state, params = alternatives.pop()
+            elif state is None:
+                return params
+            else:
+                raise IndexError("More data needed")
+
+    def run_checked(self, state, params):
+        # Like run(), but enforces the per-record limits, and optionally
+        # memoizes failures and collects stats. The stepping is done by
+        # step_checked(); this only times the record for the stats.
+        stats = self.stats
+        if stats is None:
+            return self.step_checked(state, params)
+        startindex = params[1]
+        backtracks = stats.total_backtracks
+        started = time.time()
         try:
-            # get a char
-            c = self.get_char(params)
-        except BacktrackException:
-            if self.strict:
-                raise 
+            params = self.step_checked(state, params)
+        except (BacktrackException, RecordLimitException, IndexError), e:
+            stats.add_record(startindex, getattr(e, 'index', startindex), time.time() - started,
+                             stats.total_backtracks - backtracks, e)
+            raise
+        stats.add_record(startindex, params[1], time.time() - started,
+                         stats.total_backtracks - backtracks)
+        return params
+
+    def step_checked(self, state, params):
+        # With memoize_failures, each state is entered at most once per
+        # record with the same position and field index. When a fallback
+        # is resumed, every state entered since it was pushed has had all
+        # of its own fallbacks tried, so they are all known to fail.
+        # Whether a state can succeed doesn't depend on the field so far,
+        # unless the field has a validator or may still turn out to be
+        # quoted (and so be too long). In those cases the field is part of
+        # the key.
+        memoize = self.memoize_failures
+        max_backtracks = self.max_backtracks
+        max_transitions = self.max_transitions
+        if self.max_record_seconds is None:
+            deadline = None
+        else:
+            deadline = time.time() + self.max_record_seconds
+        stats = self.stats
+        if stats is not None:
+            state_entries = stats.state_entries
+            state_backtracks = stats.backtracks
+        backtracks = 0
+        transitions = 0
+        alternatives = []
+        marks = []
+        entered = []
+        failed = set()
+        while True:
+            transitions += 1
+            if max_transitions is not None and transitions > max_transitions:
+                raise RecordLimitException("Too many state transitions", 'transitions', params[1])
+            # Checking the time is slow, so only do it now and then
+            if deadline is not None and not transitions & 0xff and time.time() > deadline:
+                raise RecordLimitException("Record took too long", 'seconds', params[1])
+            if stats is not None:
+                name = state.__name__
+                state_entries[name] += 1
+            if memoize:
+                charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+                name = state.__name__
+                if name in UNQUOTED_STATES and field_index not in self.content_validation_rules:
+                    key = (name, index, field_index)
+                else:
+                    key = (name, index, field_index, start, prefix)
+                if key in failed:
+                    self.pruned_states += 1
+                    state, params = self.fail("Known to fail", params)
+                else:
+                    entered.append(key)
+                    state, params = state(params, alternatives)
+                    while len(marks) < len(alternatives):
+                        marks.append(len(entered))
+            else:
+                state, params = state(params, alternatives)
+
+            if state is FAILED:
+                if stats is not None:
+                    state_backtracks[name] += 1
+                if not alternatives:
+                    raise BacktrackException(*params)
+                backtracks += 1
+                if max_backtracks is not None and backtracks > max_backtracks:
+                    raise RecordLimitException("Too many backtracks", 'backtracks', params[1][1])
+                state, params = alternatives.pop()
+                if memoize:
+                    mark = marks.pop()
+                    failed.update(entered[mark:])
+                    del entered[mark:]
+            elif state is None:
+                return params
+            elif state is NEED_MORE:
+                raise IndexError("More data needed")
+
+    def iter_records(self, fileobj, encoding='utf-8', chunk_size=65536, rejects=None, record_index=None):
+        # Parse records from fileobj, reading chunk_size bytes at a time.
+        # Consumed text is only dropped when more data is needed, so the
+        # buffer holds at most one read plus the record being parsed.
+        #
+        # If rejects is a RejectLog (see delim.rejects), records that fail
+        # to parse are added to it instead of raising. Parsing resumes
+        # after the first linebreak from which a record parses.
+        #
+        # If record_index is a RecordIndex (see delim.index), the byte
+        # offsets of the records it wants are added to it, counting from
+        # the current position of fileobj. The text between them is
+        # encoded again to count its bytes, so that's only done with a
+        # record_index.
+        if record_index is not None:
+            encoder = codecs.getincrementalencoder(encoding)()
+            byte_offset = fileobj.tell()
+            # where byte_offset is in charbuffer
+            counted = 0
+        decoder = codecs.getincrementaldecoder(encoding)()
+        linebreak = LINEBREAKS[self.newline]
+        charbuffer = u''
+        index = 0
+        buffer_is_final = False
+        # where charbuffer starts in the stream
+        offset = 0
+        # (offset, error offset, exception) of the text being skipped
+        reject = None
+        while True:
+            if buffer_is_final and index == len(charbuffer):
+                if reject is not None:
+                    rejects.add(reject[0], offset+index-reject[0], reject[1], reject[2])
+                return
+            try:
+                record, end = self.parse(charbuffer, index, buffer_is_final)
+            except IndexError:
+                if buffer_is_final:
+                    raise
+                if record_index is not None:
+                    byte_offset += len(encoder.encode(charbuffer[counted:index]))
+                    counted = 0
+                charbuffer, buffer_is_final = self.read_more(fileobj, decoder, chunk_size, charbuffer, index)
+                offset += index
+                index = 0
+                continue
+            except (BacktrackException, RecordLimitException), e:
+                if rejects is None:
+                    raise
+                if reject is None:
+                    reject = (offset+index, offset+e.index, e)
+                # Skip to the next linebreak. Without one, either reject
+                # the rest of the file or read more and search again from
+                # the same place.
+                i = charbuffer.find(linebreak, index)
+                if i >= 0:
+                    index = i + len(linebreak)
+                elif buffer_is_final:
+                    index = len(charbuffer)
+                else:
+                    if record_index is not None:
+                        byte_offset += len(encoder.encode(charbuffer[counted:index]))
+                        counted = 0
+                    charbuffer, buffer_is_final = self.read_more(fileobj, decoder, chunk_size, charbuffer, index)
+                    offset += index
+                    index = 0
+                continue
+            if reject is not None:
+                rejects.add(reject[0], offset+index-reject[0], reject[1], reject[2])
+                reject = None
+            if record_index is not None:
+                if record_index.wants(record_index.records):
+                    byte_offset += len(encoder.encode(charbuffer[counted:index]))
+                    counted = index
+                    record_index.offsets.append(byte_offset)
+                record_index.records += 1
+            index = end
+            yield record
+
+    def seek_record(self, fileobj, record_index, n, encoding='utf-8', chunk_size=65536, rejects=None):
+        # Iterate over the records of fileobj from record n on, starting
+        # from the closest record in record_index (see delim.index) and
+        # skipping the ones before n. Records are counted the way
+        # iter_records() counted them when it built the index, so rejects
+        # has to be given if it was then.
+        record_number, offset = record_index.lookup(n)
+        fileobj.seek(offset)
+        records = self.iter_records(fileobj, encoding, chunk_size, rejects)
+        return itertools.islice(records, n - record_number, None)
+
+    def resume_records(self, fileobj, record_index, encoding='utf-8', chunk_size=65536, rejects=None):
+        # Like seek_record(), but continue from record_index.records, the
+        # number of records handled when the index was saved, and keep
+        # adding to the index
+        n = record_index.records
+        record_number, offset = record_index.truncate(n)
+        fileobj.seek(offset)
+        records = self.iter_records(fileobj, encoding, chunk_size, rejects, record_index)
+        return itertools.islice(records, n - record_number, None)
+
+    def read_more(self, fileobj, decoder, chunk_size, charbuffer, index):
+        # Drop the consumed text from charbuffer and append a chunk.
+        # Read at least as much as is left over, so records longer than
+        # chunk_size don't get reparsed once per chunk.
+        data = fileobj.read(max(chunk_size, len(charbuffer)-index))
+        if isinstance(data, unicode):
+            text = data
+        else:
+            text = decoder.decode(data, not data)
+        return charbuffer[index:] + text, not data
+
+    def parse_batch(self, batch, charbuffer, startindex=0, buffer_is_final=True):
+        # Parse records into a ColumnBatch until it is full or the buffer
+        # runs out, and return the index after the last record parsed.
+        # That falls short of the end of a buffer that isn't final if the
+        # last record needs more data.
+        index = startindex
+        append = batch.append
+        while not batch.full():
+            if buffer_is_final and index == len(charbuffer):
+                break
+            try:
+                record, index = self.parse_record(charbuffer, index, buffer_is_final)
+            except IndexError:
+                break
+            append(record)
+        return index
+
+    def make_batch(self, batch_size=1024, types=None):
+        # An empty ColumnBatch for the selected fields
+        if self.selected_fields is None:
+            return ColumnBatch(self.field_count, batch_size, types)
+        return ColumnBatch(len(self.selected_fields), batch_size, types, self.selected_fields)
+
+    def iter_batches(self, fileobj, encoding='utf-8', chunk_size=65536, batch_size=1024, types=None):
+        # Like iter_records(), but yields ColumnBatches of batch_size
+        # records. types maps field indexes to column types, see
+        # delim.columns.
+        decoder = codecs.getincrementaldecoder(encoding)()
+        charbuffer = u''
+        index = 0
+        buffer_is_final = False
+        batch = self.make_batch(batch_size, types)
+        while True:
+            index = self.parse_batch(batch, charbuffer, index, buffer_is_final)
+            if batch.full():
+                yield batch.finish()
+                batch = self.make_batch(batch_size, types)
+            elif buffer_is_final:
+                if len(batch):
+                    yield batch.finish()
+                return
+            else:
+                charbuffer, buffer_is_final = self.read_more(fileobj, decoder, chunk_size, charbuffer, index)
+                index = 0
+
+    @handler
+    def start_field(self, params, alternatives):
+        # get a char
+        c = self.get_char(params)
+
+        if c is None:
+            if self.strict or not params[2]:
+                return self.end_of_buffer(params)
             else:
-                return self.emit(params)
+                return self.emit, params
 
-        if c == SPACE:
+        elif c == SPACE:
             if self.skipinitialspace:
-                return self.start_field(self.skip(params))
+                return self.start_field, self.skip(params)
             else:
-                return self.start_field(self.save(params, c))
+                return self.start_field, self.save(params)
 
         elif c == self.quotechar:
-            return self.opening_quote(params) # , c)
+            return self.opening_quote, params
 
         else:
-            return self.in_unquoted_field(params)
+            return self.in_unquoted_field, params
 
     @handler
-    def in_unquoted_field(self, params):
+    def in_unquoted_field(self, params, alternatives):
+        params = self.save_ordinary(params, self.unquoted_special_chars)
+
         # Get a char
-        try:
-            c = self.get_char(params)
+        c = self.get_char(params)
+
         # The backtrack option at EOF is to see if we can emit
-        except BacktrackException, e:
-            # EOF
-            if self.strict:
-                raise
+        if c is None:
+            if self.strict or not params[2]:
+                return self.end_of_buffer(params)
             else:
                 # if nonstrict, emit
-                return self.emit(params)
+                return self.emit, params
 
-        if c == self.delimiter:
+        elif c == self.delimiter:
             # delegate
-            return self.delimiter_in_unquoted_field(params)
+            return self.delimiter_in_unquoted_field, params
 
         elif c == self.escapechar:
-            # The next character must be defined, so any IndexError cannot be handled here
-            # At EOF, get_char() will raise a BacktrackError
-            nextchar = self.get_char(params, 1)
-            return self.in_unquoted_field(self.save(self.skip(params), nextchar))
+            # The next character must be defined
+            if self.get_char(params, 1) is None:
+                return self.end_of_buffer(params)
+            return self.in_unquoted_field, self.save(self.skip(params))
 
         elif c == LF and self.newline == 'UNIX':
             # delegate
-            return self.single_char_linebreak_in_unquoted_field(params)
+            return self.single_char_linebreak_in_unquoted_field, params
 
-        elif c == CR:
-            if self.newline == 'MAC':
-                # delegate
-                return self.single_char_linebreak_in_unquoted_field(params)
+        elif c == CR and self.newline == 'MAC':
+            # delegate
+            return self.single_char_linebreak_in_unquoted_field, params
 
-            if self.newline == 'DOS':
-                # delegate
-                return self.cr_in_unquoted_field(params)
+        elif c == CR and self.newline == 'DOS':
+            # delegate
+            return self.cr_in_unquoted_field, params
 
         else:
             # save and advance
-            return self.in_unquoted_field(self.save(params, c))
+            return self.in_unquoted_field, self.save(params)
 
     @handler
-    def delimiter_in_unquoted_field(self, params):
+    def delimiter_in_unquoted_field(self, params, alternatives):
         if self.can_save_unquoted_delimiter(params):
-            try:
-                c = self.get_char(params)
-                return self.in_unquoted_field(self.save(params, c))
-            except BacktrackException:
-                self.log.debug("Tried saving delimiter but failed", params)
-        return self.start_field(self.close_field(self.skip(params)))
+            # try saving the delimiter (greedy), closing the field is the fallback
+            alternatives.append((self.closing_delimiter, params))
+            return self.in_unquoted_field, self.save(params)
+        return self.closing_delimiter, params
 
     @handler
-    def single_char_linebreak_in_unquoted_field(self, params):
+    def closing_delimiter(self, params, alternatives):
+        closed = self.close_field(self.skip(params))
+        if closed is None:
+            return self.fail("Can't close", params)
+        return self.start_field, closed
+
+    @handler
+    def single_char_linebreak_in_unquoted_field(self, params, alternatives):
         if (not self.at_eof(params, 1) and
             self.can_save_unquoted_linebreak(params)):
-            try:
-                # so try saving the linebreak (greedy)
-                c = self.get_char(params)
-                return self.in_unquoted_field(self.save(params, c))
-            except BacktrackException, e:
-                # didn't work, emit or backtrack
-                pass
-        return self.emit(self.skip(params))
+            # so try saving the linebreak (greedy), emit is the fallback
+            alternatives.append((self.emit, self.skip(params)))
+            return self.in_unquoted_field, self.save(params)
+        return self.emit, self.skip(params)
 
     @handler
-    def cr_in_unquoted_field(self, params):
+    def cr_in_unquoted_field(self, params, alternatives):
         # try looking at nextchar
-        try:
-            nextchar = self.get_char(self.skip(params))
-        except BacktrackException:
+        nextchar = self.get_char(params, 1)
+
+        if nextchar is None:
+            if not params[2]:
+                return NEED_MORE, params
             # eof after CR, save CR and handle EOF
-            return self.in_unquoted_field(self.save(params, c))
+            return self.in_unquoted_field, self.save(params)
 
-        if nextchar == LF:
+        elif nextchar == LF:
             # special case: line breaks immediately before eof never get saved
             if (not self.at_eof(params, 2) and 
                 self.can_save_unquoted_linebreak(params)):
-                # we can save the CRLF
-                try:
-                    # so try saving CRLF (greedy)
-                    return self.in_unquoted_field(self.save(self.skip(params), CR+LF))
-                except BacktrackException:
-                    # didn't work, emit or backtrack
-                    pass
+                # we can save the CRLF, so try that (greedy), emit is the fallback
+                alternatives.append((self.emit, self.skip(params, 2)))
+                return self.in_unquoted_field, self.save(params, 2)
             # we can't save the linebreak
-            return self.emit(self.skip(params, 2))
+            return self.emit, self.skip(params, 2)
 
         else:
             # Note that we can't save nextchar now - it might be the delimiter or the escapechar
-            return self.in_unquoted_field(self.save(params, c))
+            return self.in_unquoted_field, self.save(params)
 
     @handler
-    def opening_quote(self, params):
+    def opening_quote(self, params, alternatives):
         if self.quoting:
-            if self.minimalquoting:
-                try:
-                    return self.in_minimally_quoted_field(self.save(params, c))
-                except BacktrackException:
-                    # Well, that didn't work
-                    pass
-            try:
-                return self.in_quoted_field(self.skip(params))
-            except BacktrackException:
-                if self.unclosedquoting:
-                    try:
-                        return self.in_unclosed_quoted_field(self.skip(params))
-                    except BacktrackException:
-                        print "giving up on quoting"
-                        pass
-        c = self.get_char(params)
-        return self.in_unquoted_field(self.save(params, c))
+            # Push the fallbacks in reverse order of preference: minimal
+            # quoting, then quoting, then unclosed quoting, then no quoting
+            alternatives.append((self.in_unquoted_field, self.save(params)))
             # TODO: warn about quoting seen, but not used
+            if self.unclosedquoting:
+                alternatives.append((self.in_unclosed_quoted_field, self.skip(params)))
+            if self.minimalquoting:
+                alternatives.append((self.in_quoted_field, self.skip(params)))
+                return self.in_minimally_quoted_field, self.save(params)
+            return self.in_quoted_field, self.skip(params)
+        return self.in_unquoted_field, self.save(params)
 
     @handler
-    def in_quoted_field(self, params):
+    def in_quoted_field(self, params, alternatives):
         # In a quoted field, we always expect to see more characters,
-        # so we can never handle IndexErrors.
+        # so we can never handle running out of them.
+
+        # Don't scan further than the point where the field gets too long
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = params
+        endpos = start + self.max_field_length - len(prefix) + 1
+        params = self.save_ordinary(params, self.quoted_special_chars, endpos)
 
-        self.check_field_length(params)
+        if self.field_too_long(params):
+            return self.fail("Field too long", params)
 
         c = self.get_char(params)
-        
-        if c == self.quotechar:
-            return self.quote_in_quoted_field(self.skip(params))
+
+        if c is None:
+            return self.end_of_buffer(params)
+
+        elif c == self.quotechar:
+            return self.quote_in_quoted_field, self.skip(params)
 
         elif c == self.escapechar:
-            # Again, the next character must be defined, so any IndexError 
-            # cannot be handled here. If we're at EOF, a BacktrackException
-            # will be thrown instead.
-            nextchar = self.get_char(params, 1)
-            return self.in_quoted_field(self.save(self.skip(params), nextchar))
+            # Again, the next character must be defined
+            if self.get_char(params, 1) is None:
+                return self.end_of_buffer(params)
+            return self.in_quoted_field, self.save(self.skip(params))
 
         else:
-            return self.in_quoted_field(self.save(params, c))
+            return self.in_quoted_field, self.save(params)
 
     @handler
-    def quote_in_quoted_field(self, params):
-        try:
-            c = self.get_char(params)
-        except BacktrackException:
-            if self.strict:
-                raise
+    def quote_in_quoted_field(self, params, alternatives):
+        c = self.get_char(params)
+
+        if c is None:
+            if self.strict or not params[2]:
+                return self.end_of_buffer(params)
             else:
-                return self.emit(params)
+                return self.emit, params
 
-        if c == self.delimiter:
-            return self.start_field(self.close_field(self.skip(params)))
+        elif c == self.delimiter:
+            return self.closing_delimiter, params
 
         elif c == self.quotechar:
             if self.doublequote:
-                return self.in_quoted_field(self.save(params, c))
+                return self.in_quoted_field, self.save(params)
             else:
-                raise BacktrackException("Data after closing quote", params)
+                return self.fail("Data after closing quote", params)
 
         elif c == LF and self.newline == 'UNIX':
-            return self.emit(self.skip(params)), index+1
+            return self.emit, self.skip(params)
         elif c == CR:
             if self.newline == 'MAC':
-                return self.emit(self.skip(params)), index+1
+                return self.emit, self.skip(params)
             elif self.newline == 'DOS':
-                return self.emit(self.match_string(params, CR+LF))
-#                nextchar = self.get_char(self.skip(params))
-#                if nextchar == LF:
-#                    return self.emit(self.skip(params, 2))
+                nextchar = self.get_char(params, 1)
+                if nextchar is None:
+                    return self.end_of_buffer(self.skip(params))
+                elif nextchar != LF:
+                    return self.fail("Failed to match %s" % (CR+LF), self.skip(params))
+                return self.emit, self.skip(params, 2)
 
             # Not that we can not save nextchar now - it might be the delimiter or the escapechar
-            return self.in_unquoted_field(self.save(params, c))
+            return self.in_unquoted_field, self.save(params)
 
         else:
-            raise BacktrackException("Data after closing quote", params)
+            return self.fail("Data after closing quote", params)
 
     @handler
-    def in_unclosed_quoted_field(self, params):
+    def in_unclosed_quoted_field(self, params, alternatives):
         # If we see EOF, we pretend it was preceded by a quote and delegate 
         # to quote_in_quoted_field
-        try:
-            c = self.get_char(params)
-        except BacktrackException:
-            return self.quote_in_quoted_field(params)
+        c = self.get_char(params)
 
-        if c == self.quotechar:
-            raise BacktrackException("Quote seen while trying to parse unclosed quoted field.", params)
+        if c is None:
+            if not params[2]:
+                return NEED_MORE, params
+            return self.quote_in_quoted_field, params
+
+        elif c == self.quotechar:
+            return self.fail("Quote seen while trying to parse unclosed quoted field.", params)
 
         elif c == LF or c == CR or c == self.delimiter:
-            try:
-                # Pretend we just saw a quote and delegate 
-                # to quote_in_quoted_field
-                return self.quote_in_quoted_field(params) 
-            except BacktrackException:
-                # If that fails, save and proceed
-                return self.in_unclosed_quoted_field(self.save(params, c))
+            # Pretend we just saw a quote and delegate to
+            # quote_in_quoted_field. If that fails, save and proceed
+            alternatives.append((self.in_unclosed_quoted_field, self.save(params)))
+            return self.quote_in_quoted_field, params
 
         elif c == self.escapechar:
-            # The next character must be defined, so any IndexError cannot be handled here
-            # get_char() will raise a BacktrackException at EOF
-            nextchar = self.get_char(self.skip(params))
-            return self.in_unclosed_quoted_field(self.save(self.skip(params, 2), nextchar))
+            # The next character must be defined
+            if self.get_char(params, 1) is None:
+                return self.end_of_buffer(params)
+            return self.in_unclosed_quoted_field, self.save(self.skip(params))
         else:
-            return self.in_unclosed_quoted_field(self.save(params, c))
+            return self.in_unclosed_quoted_field, self.save(params)
 
     @handler
-    def in_minimally_quoted_field(self, params):
+    def in_minimally_quoted_field(self, params, alternatives):
         c = self.get_char(params)
 
+        if c is None:
+            return self.end_of_buffer(params)
         if c==LF or c==CR or c==self.delimiter or c==self.escapechar:
-            raise BacktrackException("Non-minimal quoting", params)
+            return self.fail("Non-minimal quoting", params)
         if c == self.quotechar:
-            return self.quote_in_quoted_field(self.save(params, c))
+            return self.quote_in_quoted_field, self.save(params)
         else:
-            return self.in_minimally_quoted_field(self.save(params, c))
+            return self.in_minimally_quoted_field, self.save(params)
 
     @handler
-    def emit(self, params):
-        charbuffer, index, buffer_is_final, record, field = self.close_field(params, last_field=True)
-        return record, index
+    def emit(self, params, alternatives):
+        closed = self.close_field(params, last_field=True)
+        if closed is None:
+            return self.fail("Can't close", params)
+        charbuffer, index, buffer_is_final, record, field_index, start, prefix = closed
+        if self.selected_fields is not None:
+            record = [record[i] for i in self.selected_fields]
+        return None, (record, index)
@@ -0,0 +1,44 @@
+import random
+from collections import namedtuple
+
+# Records that failed to parse, see Parser.iter_records().
+#
+# offset is where the rejected text starts in the stream (in characters),
+# length how much of it was skipped to get back in sync, and error_offset
+# where the parser gave up. record and field are the partial record and
+# field at that point, or None if a RecordLimitException stopped it.
+
+Reject = namedtuple('Reject', 'offset length error_offset message record field')
+
+
+class RejectLog(object):
+    # Keeps at most capacity rejects. Once more than that have been seen,
+    # the ones kept are a uniform sample of all of them (reservoir
+    # sampling), so a badly broken file can't use up memory.
+
+    def __init__(self, capacity=100, seed=None):
+        self.capacity = capacity
+        self.count = 0
+        self.rejects = []
+        self.random = random.Random(seed)
+
+    def add(self, offset, length, error_offset, exception):
+        self.count += 1
+        if len(self.rejects) < self.capacity:
+            i = len(self.rejects)
+            self.rejects.append(None)
+        else:
+            i = self.random.randrange(self.count)
+            if i >= self.capacity:
+                return
+        # Only slice the partial record and field out of the buffer for
+        # the rejects that are kept
+        self.rejects[i] = Reject(offset, length, error_offset, exception.message,
+                                 getattr(exception, 'record', None),
+                                 getattr(exception, 'field', None))
+
+    def __len__(self):
+        return len(self.rejects)
+
+    def __iter__(self):
+        return iter(self.rejects)
@@ -0,0 +1,180 @@
+import abc
+import re
+
+# Declarative validation rules, for Parser.add_validation_rules() or for
+# checking ColumnBatches after parsing, see validate_batch().
+#
+# Each rule is set up once (regular expressions are compiled, values put
+# in a frozenset) and is then a picklable callable that takes the text of
+# a field and returns whether it's valid. compile() returns a callable
+# with the same truth value that skips the Python call where it can, which
+# Parser.compile() uses.
+#
+# While parsing, a validator is called for every trial close of its field.
+# For rules with cache_results, which cost more than looking up a result,
+# the parser keeps each record's results by field and span, so a close
+# that's tried again after backtracking doesn't call the rule again.
+#
+# invalid_rows(column) checks a whole column of a finished ColumnBatch.
+# Length works from the offsets of string columns, without slicing the
+# values. Null values are valid. Typed columns hold converted values,
+# which only Number checks directly; the other rules check their text.
+
+
+class Rule(object):
+    __metaclass__ = abc.ABCMeta
+
+    cache_results = False
+
+    @abc.abstractmethod
+    def __call__(self, field):
+        pass
+
+    def compile(self):
+        return self
+
+    def check_value(self, value):
+        # Check a value from a ColumnBatch column
+        if not isinstance(value, unicode):
+            value = unicode(value)
+        return self(value)
+
+    def invalid_rows(self, column):
+        # The indexes of the column's values that aren't valid
+        check = self.check_value
+        return [i for i in range(len(column)) if not column.is_null(i) and not check(column[i])]
+
+
+class Regex(Rule):
+    # The whole field has to match pattern
+    cache_results = True
+
+    def __init__(self, pattern, flags=re.UNICODE):
+        self.pattern = pattern
+        self.flags = flags
+        self.match = re.compile(u'(?:%s)\\Z' % pattern, flags).match
+
+    def __call__(self, field):
+        return self.match(field) is not None
+
+    def compile(self):
+        return self.match
+
+    def invalid_rows(self, column):
+        if not hasattr(column, 'text'):
+            return Rule.invalid_rows(self, column)
+        # Each value is matched on its own, since anchors and lookbehinds
+        # would see the neighbouring values in the column's text
+        match = self.match
+        text = column.text
+        offsets = column.offsets
+        return [i for i in range(len(column))
+                if match(text[offsets[i]:offsets[i+1]]) is None and not column.is_null(i)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['match']
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state['pattern'], state['flags'])
+
+
+class Length(Rule):
+    # min_length <= len(field) <= max_length, where None is no limit
+    def __init__(self, min_length=None, max_length=None):
+        self.min_length = min_length
+        self.max_length = max_length
+
+    def __call__(self, field):
+        length = len(field)
+        return ((self.min_length is None or length >= self.min_length) and
+                (self.max_length is None or length <= self.max_length))
+
+    def invalid_rows(self, column):
+        if not hasattr(column, 'text'):
+            return Rule.invalid_rows(self, column)
+        # The lengths are differences of the offsets
+        min_length = self.min_length if self.min_length is not None else 0
+        max_length = self.max_length if self.max_length is not None else float('inf')
+        offsets = column.offsets
+        return [i for i in range(len(column))
+                if not min_length <= offsets[i+1] - offsets[i] <= max_length and not column.is_null(i)]
+
+
+class OneOf(Rule):
+    # The field is one of values
+    def __init__(self, values):
+        self.values = frozenset(unicode(value) for value in values)
+
+    def __call__(self, field):
+        return field in self.values
+
+    def compile(self):
+        return self.values.__contains__
+
+
+class Number(Rule):
+    # The field is a number, an integer if integer is set, between minimum
+    # and maximum (inclusive, None is no limit)
+    cache_results = True
+
+    def __init__(self, minimum=None, maximum=None, integer=False):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.integer = integer
+
+    def __call__(self, field):
+        try:
+            if self.integer:
+                value = int(field)
+            else:
+                value = float(field)
+        except ValueError:
+            return False
+        return self.in_range(value)
+
+    def in_range(self, value):
+        return ((self.minimum is None or value >= self.minimum) and
+                (self.maximum is None or value <= self.maximum))
+
+    def check_value(self, value):
+        if isinstance(value, unicode):
+            return self(value)
+        if self.integer and isinstance(value, float) and not value.is_integer():
+            return False
+        return self.in_range(value)
+
+
+class All(Rule):
+    # Every one of rules holds, checked in order
+    def __init__(self, *rules):
+        self.rules = rules
+        self.cache_results = any(rule.cache_results for rule in rules)
+
+    def __call__(self, field):
+        for rule in self.rules:
+            if not rule(field):
+                return False
+        return True
+
+    def invalid_rows(self, column):
+        invalid = set()
+        for rule in self.rules:
+            invalid.update(rule.invalid_rows(column))
+        return sorted(invalid)
+
+
+def validate_batch(batch, rules):
+    # Check the columns of a finished ColumnBatch against rules, a dict of
+    # Rules by field index. Returns a dict of the invalid rows by field
+    # index, for the fields that have any.
+    invalid = {}
+    for column in batch.columns:
+        rule = rules.get(column.field_index)
+        if rule is None:
+            continue
+        rows = rule.invalid_rows(column)
+        if rows:
+            invalid[column.field_index] = rows
+    return invalid
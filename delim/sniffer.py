@@ -0,0 +1,313 @@
+import re
+from collections import Counter
+
+from util import MetadataException
+from parser import Parser, BacktrackException, RecordLimitException, LINEBREAKS
+
+# Guess the dialect of a file from a sample of its start, see sniff().
+#
+# Everything is worked out from character counts, taken with
+# unicode.count() and regular expressions, so Python code only loops over
+# the lines of the sample, never over its characters:
+#
+#  - the escapechar from backslashes before delimiters, quotes or
+#    linebreaks. Escaped characters are then removed.
+#  - the newline from the counts of CR, LF and CRLF
+#  - the quotechar from quotes next to candidate delimiters. Quoted text
+#    is then removed, so quoted delimiters and linebreaks aren't counted.
+#  - the delimiter from how consistent its count per line is
+#  - the field count, and the fields with spare delimiters or linebreaks,
+#    from the line shapes that explain the most lines, see explain()
+#  - unclosed quoting from lines with an odd number of quotes that still
+#    have the right number of delimiters
+#
+# The proposed parser is then tried on the first records of the sample.
+#
+# The fields with spare delimiters are only told apart by the types of
+# the columns. Where such a field sits among columns of its own type (say,
+# several text columns in a row), every placement of the spare delimiters
+# explains a line equally well, so no field is picked, and the lines with
+# spare delimiters fail the check and bring the confidence down instead.
+
+DELIMITERS = [u',', u';', u'\t', u'|', u':']
+QUOTECHARS = [u'"', u"'"]
+ESCAPECHAR = u'\\'
+NULLSTRINGS = frozenset([u'NULL', u'null', u'\\N', u'NA', u'N/A', u'None', u'nil'])
+
+MAX_SAMPLE = 1 << 20
+# Lines used to work out the field count and spare delimiters
+MAX_SHAPE_LINES = 500
+# Whole records used to find the usual type of each column
+MAX_TYPE_ROWS = 100
+# Lines with more extra delimiters than this aren't aligned with the
+# columns, and count as unexplained
+MAX_EXTRA_DELIMITERS = 8
+# Counts of delimiters per line held by fewer lines than this fraction
+# aren't considered as the field count
+MIN_COUNT_FRACTION = 0.05
+# Records parsed to check the proposed parser
+MAX_CHECK_RECORDS = 50
+
+INTEGER = re.compile(ur'^[-+]?\d+$', re.UNICODE)
+DECIMAL = re.compile(ur'^[-+]?(\d+\.\d*|\.\d+)([eE][-+]?\d+)?$', re.UNICODE)
+
+
+def sniff_escapechar(sample):
+    special = u''.join(re.escape(c) for c in DELIMITERS + QUOTECHARS + [u'\r', u'\n'])
+    if re.search(u'%s[%s]' % (re.escape(ESCAPECHAR), special), sample):
+        return ESCAPECHAR
+    return None
+
+
+def sniff_newline(sample):
+    crlf = sample.count(u'\r\n')
+    cr = sample.count(u'\r') - crlf
+    lf = sample.count(u'\n') - crlf
+    if crlf and crlf >= cr and crlf >= lf:
+        return u'DOS'
+    if cr > lf:
+        return u'MAC'
+    return u'UNIX'
+
+
+def sniff_quotechar(sample, linebreak):
+    # A quotechar opens and closes fields, so it's mostly found at the
+    # start of a line or after a delimiter, or before one or a linebreak
+    delimiters = u''.join(re.escape(d) for d in DELIMITERS)
+    best, best_count = None, 0
+    for quotechar in QUOTECHARS:
+        if quotechar not in sample:
+            continue
+        q = re.escape(quotechar)
+        pattern = u'(?:^|[%s])%s|%s(?:[%s]|%s|$)' % (delimiters, q, q, delimiters, re.escape(linebreak))
+        count = len(re.findall(pattern, sample, re.MULTILINE))
+        if count > best_count:
+            best, best_count = quotechar, count
+    return best
+
+
+def strip_quoted(sample, quotechar):
+    # Doubled quotes split a field into quoted spans that are removed
+    # one after the other
+    q = re.escape(quotechar)
+    return re.sub(u'%s[^%s]*%s' % (q, q, q), u'', sample)
+
+
+def sniff_delimiter(lines):
+    # The delimiter whose most common count per line is held by the most
+    # lines. Ties go to the delimiter that splits lines into more fields.
+    best = None
+    for delimiter in DELIMITERS:
+        counts = Counter(line.count(delimiter) for line in lines)
+        count, lines_with_count = counts.most_common(1)[0]
+        if count == 0:
+            continue
+        key = (lines_with_count, count)
+        if best is None or key > best[0]:
+            best = (key, delimiter)
+    if best is None:
+        raise MetadataException("Can't find a delimiter in the sample")
+    return best[1]
+
+
+def field_type(field):
+    if not field:
+        return 'empty'
+    if INTEGER.match(field):
+        return 'integer'
+    if DECIMAL.match(field):
+        return 'decimal'
+    return 'text'
+
+
+def column_types(rows, field_count):
+    # The most common field_type() of each column
+    types = []
+    for i in range(field_count):
+        counts = Counter(field_type(row[i]) for row in rows)
+        types.append(counts.most_common(1)[0][0])
+    return types
+
+
+def align(part_types, types):
+    # Line up the parts of a line that has too many delimiters with the
+    # columns, each column taking one or more consecutive parts, so that
+    # as many columns as possible get a field of their usual type. A
+    # field made of several parts holds a delimiter, so it's text.
+    #
+    # Returns the columns that take more than one part, or None if more
+    # than one alignment is best.
+    n = len(types)
+    extra = len(part_types) - n
+    # best[j][e]: (score, ways, parts taken by column j-1) for the first j
+    # columns taking j+e parts
+    best = [[None] * (extra+1) for j in range(n+1)]
+    best[0][0] = (0, 1, 0)
+    for j in range(1, n+1):
+        for e in range(extra+1):
+            score, ways, size = -1, 0, 0
+            for taken in range(1, e+2):
+                previous = best[j-1][e-taken+1]
+                if previous is None:
+                    continue
+                if taken == 1:
+                    t = part_types[j+e-1]
+                else:
+                    t = 'text'
+                s = previous[0] + (t == types[j-1])
+                if s > score:
+                    score, ways, size = s, previous[1], taken
+                elif s == score:
+                    ways += previous[1]
+            best[j][e] = (score, ways, size)
+    if best[n][extra][1] > 1:
+        return None
+    absorbing = []
+    e = extra
+    for j in range(n, 0, -1):
+        taken = best[j][e][2]
+        if taken > 1:
+            absorbing.append(j-1)
+        e -= taken - 1
+    return absorbing
+
+
+def explain(rows, field_count):
+    # Returns (explained, spare_delimiters, spare_linebreaks) for the
+    # lines split into rows, assuming records have field_count fields.
+    # explained is the number of lines that are either a whole record, a
+    # record with spare delimiters, or one of two lines that make up a
+    # record split by a linebreak. The other two are Counters of the
+    # fields that hold them.
+    exact = [row for row in rows if len(row) == field_count]
+    if not exact:
+        return 0, Counter(), Counter()
+    types = None
+    explained = len(exact)
+    spare_delimiters = Counter()
+    spare_linebreaks = Counter()
+    i = 0
+    while i < len(rows):
+        row = rows[i]
+        if field_count < len(row) <= field_count + MAX_EXTRA_DELIMITERS:
+            explained += 1
+            if types is None:
+                types = column_types(exact[:MAX_TYPE_ROWS], field_count)
+            absorbing = align([field_type(part) for part in row], types)
+            if absorbing:
+                spare_delimiters.update(absorbing)
+        elif len(row) < field_count and i+1 < len(rows) and len(row) + len(rows[i+1]) - 1 == field_count:
+            # The linebreak is in the last field of the first line
+            explained += 2
+            spare_linebreaks[len(row)-1] += 1
+            i += 1
+        i += 1
+    return explained, spare_delimiters, spare_linebreaks
+
+
+def sniff(sample, encoding='utf-8'):
+    # Propose a configured Parser for a sample from the start of a file.
+    # Returns (parser, confidence), where confidence is the fraction of
+    # the sample's lines that the dialect explains times the fraction of
+    # its first records that the parser parses. The sample may be bytes,
+    # in which case it's decoded with encoding. Only the first MAX_SAMPLE
+    # characters are looked at.
+    if isinstance(sample, bytes):
+        sample = sample.decode(encoding, 'replace')
+    sample = sample[:MAX_SAMPLE]
+
+    escapechar = sniff_escapechar(sample)
+    text = sample
+    if escapechar is not None:
+        text = re.sub(u'%s(\r\n|.)' % re.escape(escapechar), u'', text, flags=re.DOTALL)
+    newline = sniff_newline(text)
+    linebreak = LINEBREAKS[newline]
+    quotechar = sniff_quotechar(text, linebreak)
+    if quotechar is not None:
+        text = strip_quoted(text, quotechar)
+
+    # The last line is probably cut short, unless it's the only one
+    lines = text.split(linebreak)
+    if len(lines) > 1:
+        lines.pop()
+    lines = [line for line in lines if line]
+    if not lines:
+        raise MetadataException("The sample has no lines")
+    delimiter = sniff_delimiter(lines)
+
+    # Try the counts of delimiters per line that are common enough
+    rows = [line.split(delimiter) for line in lines[:MAX_SHAPE_LINES]]
+    counts = Counter(len(row) for row in rows)
+    best = None
+    for field_count, lines_with_count in counts.iteritems():
+        if field_count < 2 or lines_with_count < MIN_COUNT_FRACTION * len(rows):
+            continue
+        explained, spare_delimiters, spare_linebreaks = explain(rows, field_count)
+        key = (explained, lines_with_count)
+        if best is None or key > best[0]:
+            best = (key, field_count, spare_delimiters, spare_linebreaks)
+    if best is None:
+        raise MetadataException("Can't find a consistent field count in the sample")
+    (explained, lines_with_count), field_count, spare_delimiters, spare_linebreaks = best
+
+    parser = Parser(field_count, delimiter, newline)
+    if escapechar is not None:
+        parser.set_escapechar(escapechar)
+    if quotechar is not None:
+        parser.set_quotechar(quotechar)
+        raw_lines = sample.split(linebreak)[:MAX_SHAPE_LINES]
+        # Doubled quotes, other than empty quoted fields
+        doubled = quotechar * 2
+        empty = re.compile(u'(?:^|%s)%s(?=%s|$)' % (re.escape(delimiter), doubled, re.escape(delimiter)))
+        parser.doublequote = any(doubled in line and doubled in empty.sub(u'', line) for line in raw_lines)
+        # An odd number of quotes in a line that has the right number of
+        # delimiters can't be a quoted linebreak
+        parser.unclosedquoting = any(line.count(quotechar) % 2 and line.count(delimiter) == field_count - 1
+                                     for line in raw_lines)
+    parser.skipinitialspace = text.count(delimiter + u' ') > 0.9 * text.count(delimiter)
+
+    # Ignore fields picked by fewer than one in ten of the lines that
+    # have spare delimiters
+    total = sum(spare_delimiters.itervalues())
+    for field_index, votes in spare_delimiters.iteritems():
+        if votes * 10 >= total:
+            parser.allow_unquoted_delimiters_in_field(field_index)
+    for field_index in spare_linebreaks:
+        parser.allow_unquoted_linebreaks_in_field(field_index)
+
+    nullstrings = set(field for row in rows if len(row) == field_count for field in row if field in NULLSTRINGS)
+    for nullstring in nullstrings:
+        parser.add_nullstring(nullstring)
+
+    confidence = float(explained) / len(rows) * check(parser, sample)
+    return parser, confidence
+
+
+def check(parser, sample):
+    # The fraction of the first records of sample that parse. Only text up
+    # to the last linebreak is parsed, since the sample may end in the
+    # middle of a record.
+    linebreak = LINEBREAKS[parser.newline]
+    end = sample.rfind(linebreak)
+    if end < 0:
+        return 0.0
+    text = sample[:end+len(linebreak)]
+    parser.max_backtracks = 1000
+    parser.compile()
+    index = 0
+    parsed = failed = 0
+    try:
+        while index < len(text) and parsed + failed < MAX_CHECK_RECORDS:
+            try:
+                record, index = parser.parse(text, index, True)
+                parsed += 1
+            except (BacktrackException, RecordLimitException):
+                failed += 1
+                # Carry on after the next linebreak
+                index = text.find(linebreak, index)
+                if index < 0:
+                    break
+                index += len(linebreak)
+    finally:
+        parser.max_backtracks = None
+    return float(parsed) / max(parsed + failed, 1)
@@ -0,0 +1,78 @@
+from collections import defaultdict
+
+# Counters collected while parsing, see Parser.collect_stats().
+#
+# state_entries and backtracks are keyed by state name. A backtrack is
+# counted against the state that failed, including the last failure of a
+# record that couldn't be parsed at all. chars is the number of characters
+# consumed by the records that were parsed. Attempts that ran out of data
+# (and so will be retried with more) are counted as incomplete, and their
+# time goes into seconds like everything else.
+
+
+class ParseStats(object):
+    def __init__(self, states=(), callback=None):
+        self.state_entries = defaultdict(int)
+        self.backtracks = defaultdict(int)
+        for name in states:
+            self.state_entries[name] = 0
+            self.backtracks[name] = 0
+        self.records = 0
+        self.failed_records = 0
+        self.incomplete = 0
+        self.chars = 0
+        self.seconds = 0.0
+        self.slowest_record = 0.0
+        # Called as callback(startindex, index, seconds, backtracks, exception)
+        # after each attempt. index is where the record ended, or where the
+        # parser gave up, and exception is None if the record was parsed.
+        self.callback = callback
+
+    def add_record(self, startindex, index, seconds, backtracks, exception=None):
+        if exception is None:
+            self.records += 1
+            self.chars += index - startindex
+        elif isinstance(exception, IndexError):
+            self.incomplete += 1
+        else:
+            self.failed_records += 1
+        self.seconds += seconds
+        if seconds > self.slowest_record:
+            self.slowest_record = seconds
+        if self.callback is not None:
+            self.callback(startindex, index, seconds, backtracks, exception)
+
+    @property
+    def transitions(self):
+        return sum(self.state_entries.itervalues())
+
+    @property
+    def total_backtracks(self):
+        return sum(self.backtracks.itervalues())
+
+    def merge(self, other):
+        # Adds the counts from other, e.g. from a worker process
+        for name, count in other.state_entries.iteritems():
+            self.state_entries[name] += count
+        for name, count in other.backtracks.iteritems():
+            self.backtracks[name] += count
+        self.records += other.records
+        self.failed_records += other.failed_records
+        self.incomplete += other.incomplete
+        self.chars += other.chars
+        self.seconds += other.seconds
+        self.slowest_record = max(self.slowest_record, other.slowest_record)
+
+    def report(self):
+        lines = ["%i records, %i failed, %i chars in %.3fs (slowest record %.6fs)" %
+                 (self.records, self.failed_records, self.chars, self.seconds, self.slowest_record)]
+        for name in sorted(self.state_entries, key=self.state_entries.get, reverse=True):
+            lines.append("%-40s %10i entries %10i backtracks" %
+                         (name, self.state_entries[name], self.backtracks[name]))
+        return "\n".join(lines)
+
+    def __getstate__(self):
+        # The callback is often a closure, which can't be pickled
+        state = self.__dict__.copy()
+        state['callback'] = None
+        return state
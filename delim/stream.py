@@ -0,0 +1,118 @@
+import codecs
+
+# Parse records from data that's pushed in, rather than read from a file,
+# for event loops (asyncio, Twisted, Tornado) where the parser mustn't
+# block waiting for data. RecordStream does no I/O itself: the caller
+# feeds it chunks as they arrive and takes the records that are complete.
+#
+# A loop over an asyncio StreamReader looks like
+#
+#     stream = RecordStream(parser)
+#     while not stream.at_end():
+#         if stream.wants_data():
+#             data = await reader.read(65536)
+#             if data:
+#                 stream.feed(data)
+#             else:
+#                 stream.feed_eof()
+#         for record in stream.parse_available(1000):
+#             await queue.put(record)
+#
+# Limiting the records per call to parse_available() keeps each step
+# short, so the loop can run other tasks in between, and putting the
+# records on a bounded queue gives backpressure: while the consumer is
+# behind, the loop waits on the queue and stops reading. Since
+# parse_available() only touches the stream, it can also be run in an
+# executor (e.g. with loop.run_in_executor()) while nothing feeds it.
+#
+# A record that needs more data than has arrived is parsed again when a
+# linebreak character arrives, since only that can finish it, or once the
+# buffer has grown past twice its length so far. So a long record
+# arriving in small chunks isn't reparsed for every chunk, but a record is
+# returned as soon as its linebreak has been fed. Fed chunks are kept in
+# a list and only joined onto the buffer when a parse is due, so they
+# aren't copied for every chunk either.
+
+
+class RecordStream(object):
+    def __init__(self, parser, encoding='utf-8', high_water=1 << 20):
+        self.parser = parser
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        # See wants_data()
+        self.high_water = high_water
+        self.charbuffer = u''
+        self.index = 0
+        # Text fed since charbuffer was last joined
+        self.chunks = []
+        # The length of charbuffer and chunks together
+        self.length = 0
+        self.eof = False
+        # Don't parse the next record again until length is this much
+        self.retry_at = 0
+
+    def feed(self, data):
+        # Add a chunk of bytes (or text) to the buffer. Text that has been
+        # parsed is dropped.
+        if self.eof:
+            raise ValueError("Data fed after the end of the stream")
+        if not isinstance(data, unicode):
+            data = self.decoder.decode(data)
+        self.chunks.append(data)
+        self.length += len(data)
+        if u'\n' in data or u'\r' in data:
+            self.retry_at = 0
+
+    def feed_eof(self):
+        if not self.eof:
+            data = self.decoder.decode(b'', True)
+            self.chunks.append(data)
+            self.length += len(data)
+            self.eof = True
+
+    def join(self):
+        # Drop the text that has been parsed and add the fed chunks
+        if self.chunks:
+            self.charbuffer = self.charbuffer[self.index:] + u''.join(self.chunks)
+            self.chunks = []
+            self.length -= self.index
+            self.retry_at -= self.index
+            self.index = 0
+
+    def unparsed(self):
+        # The text after the last record parsed
+        return self.charbuffer[self.index:] + u''.join(self.chunks)
+
+    def wants_data(self):
+        # Whether more data should be fed: there's less than high_water of
+        # unparsed text, or there's more but the next record still needs
+        # more than that
+        if self.eof:
+            return False
+        return (self.length - self.index < self.high_water or
+                self.length < self.retry_at)
+
+    def at_end(self):
+        return self.eof and self.index == self.length
+
+    def parse_available(self, limit=None):
+        # Parse and return a list of at most limit records, stopping early
+        # when the rest of the buffer isn't a complete record. Parse errors
+        # are raised as by Parser.parse(), and parsing resumes from the
+        # same record, so a failing stream should be abandoned.
+        records = []
+        if not self.eof and self.length < self.retry_at:
+            return records
+        self.join()
+        charbuffer = self.charbuffer
+        while limit is None or len(records) < limit:
+            if self.index == len(charbuffer):
+                break
+            try:
+                record, self.index = self.parser.parse(charbuffer, self.index, self.eof)
+            except IndexError:
+                if self.eof:
+                    raise
+                self.retry_at = 2*len(charbuffer) - self.index
+                break
+            records.append(record)
+        return records
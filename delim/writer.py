@@ -0,0 +1,147 @@
+from parser import LINEBREAKS, CR, LF, SPACE, compile_char_class
+
+# Write records in the dialect of a Parser, so that parsing the output with
+# that parser gives the records back, see Writer. transcode() converts a
+# file from one dialect to another.
+#
+# Fields are quoted only when they have to be: when they hold the
+# delimiter, the quotechar, the escapechar or a linebreak character, or
+# start with a space that skipinitialspace would skip. Without a
+# quotechar, those characters are escaped instead. So they are in fields
+# longer than the dialect's max_field_length, which the parser doesn't
+# read as quoted fields. None is written as the dialect's nullstring (the
+# first in sorted order, unless another is given, or an empty field if it
+# has none), and an empty string as an emptystring if the empty string is
+# a nullstring. A value that would be read back as something else, like
+# the text of a nullstring, or a long field that can't be escaped, raises
+# ValueError.
+#
+# Most records need none of that, so a record is first joined as it is,
+# and only formatted field by field if the joined line shows that it has
+# to be. Lines are collected in a list and written in one encoded chunk
+# once buffer_size characters have been collected.
+
+
+class Writer(object):
+    def __init__(self, fileobj, dialect, encoding='utf-8', buffer_size=1 << 16, nullstring=None):
+        self.fileobj = fileobj
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.delimiter = dialect.delimiter
+        self.linebreak = LINEBREAKS[dialect.newline]
+        self.quotechar = dialect.quotechar if dialect.quoting else None
+        self.escapechar = dialect.escapechar
+        self.doublequote = dialect.doublequote
+        self.skipinitialspace = dialect.skipinitialspace
+        self.max_field_length = dialect.max_field_length
+
+        if nullstring is None:
+            nullstring = min(dialect.nullstrings) if dialect.nullstrings else u''
+        self.nullstring = nullstring
+        # Values that would be read back as None or an empty string
+        emptystrings = frozenset(e for e in dialect.emptystrings if e)
+        self.reserved = frozenset(dialect.nullstrings) | emptystrings
+        self.emptystring = min(emptystrings) if emptystrings else None
+
+        specials = [self.quotechar, self.escapechar, CR, LF]
+        self.line_special = compile_char_class(specials)
+        self.field_special = compile_char_class(specials + [self.delimiter])
+
+        self.lines = []
+        self.buffered = 0
+        self.records = 0
+
+    def write_record(self, record):
+        try:
+            line = self.delimiter.join(record)
+        except TypeError:
+            # Not all strings
+            line = None
+        if line is None or not self.is_plain(line, record):
+            line = self.delimiter.join([self.format_field(value) for value in record])
+        self.lines.append(line)
+        self.lines.append(self.linebreak)
+        self.records += 1
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_records(self, records):
+        write_record = self.write_record
+        for record in records:
+            write_record(record)
+
+    def is_plain(self, line, record):
+        # Whether line, the fields of record joined, is already the line to
+        # write
+        if self.line_special.search(line) is not None:
+            return False
+        if line.count(self.delimiter) != len(record) - 1:
+            return False
+        if self.reserved and not self.reserved.isdisjoint(record):
+            return False
+        if self.skipinitialspace and (line.startswith(SPACE) or self.delimiter + SPACE in line):
+            return False
+        return True
+
+    def format_field(self, value):
+        if value is None:
+            return self.nullstring
+        if not isinstance(value, unicode):
+            value = unicode(value)
+        if value in self.reserved:
+            if value == u'' and self.emptystring is not None:
+                return self.emptystring
+            raise ValueError("%r can't be written, it would be read back as a nullstring or emptystring" % value)
+        if self.field_special.search(value) is None and not (self.skipinitialspace and value.startswith(SPACE)):
+            return value
+        return self.quote(value)
+
+    def quote(self, value):
+        quotechar = self.quotechar
+        escapechar = self.escapechar
+        if quotechar is not None and len(value) <= self.max_field_length:
+            if escapechar is not None:
+                value = value.replace(escapechar, escapechar + escapechar)
+            if quotechar in value:
+                if self.doublequote:
+                    value = value.replace(quotechar, quotechar + quotechar)
+                elif escapechar is not None:
+                    value = value.replace(quotechar, escapechar + quotechar)
+                else:
+                    raise ValueError("%r can't be written without doublequote or an escapechar" % value)
+            return quotechar + value + quotechar
+        if escapechar is not None:
+            value = self.field_special.sub(lambda match: escapechar + match.group(0), value)
+            if self.skipinitialspace and value.startswith(SPACE):
+                value = escapechar + value
+            return value
+        if quotechar is not None:
+            raise ValueError("%r can't be written quoted, it's longer than max_field_length" % value)
+        raise ValueError("%r can't be written without a quotechar or an escapechar" % value)
+
+    def flush(self):
+        if self.lines:
+            self.fileobj.write(u''.join(self.lines).encode(self.encoding))
+            del self.lines[:]
+            self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+def transcode(infile, outfile, src_parser, dst_dialect, encoding='utf-8', dst_encoding=None,
+              chunk_size=65536, rejects=None, nullstring=None):
+    # Parse infile with src_parser and write its records to outfile in the
+    # dialect of the Parser dst_dialect. Returns the number of records
+    # written. src_parser is compiled if it isn't already, see
+    # Parser.compile().
+    if src_parser.compiled is None:
+        src_parser.compile()
+    writer = Writer(outfile, dst_dialect, dst_encoding or encoding, nullstring=nullstring)
+    with writer:
+        writer.write_records(src_parser.iter_records(infile, encoding, chunk_size, rejects))
+    return writer.records
@@ -1,13 +1,58 @@
 #!/usr/bin/python
 
+import datetime
+import io
+import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
 
-from delim.parser import Parser, BacktrackException
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from delim.parser import Parser, BacktrackException, RecordLimitException
+from delim.parallel import parse_file_parallel, init_worker
+from delim.columns import ColumnBatch
+from delim.rejects import RejectLog
+from delim.index import RecordIndex
+from delim.stream import RecordStream
+from delim.intern import InternCache
+from delim.follow import Follower, Checkpoint
+from delim.writer import Writer, transcode
+from delim.rules import Rule, Regex, Length, OneOf, Number, All, validate_batch
+from delim.sniffer import sniff
+from delim.util import MetadataException
+
+
+# Validators are module level functions, so parsers can be pickled for
+# parse_file_parallel()
+def is_z(field):
+    return field == u'z'
+
+
+def slow_z(field):
+    if field == u'z':
+        time.sleep(2)
+    return True
+
+
+class CompilingParser(Parser):
+    # Compiles whenever the configuration has changed since the last parse
+    def parse(self, *args):
+        if self.compiled is None:
+            self.compile()
+        return Parser.parse(self, *args)
 
 
 class TestUnquoted(unittest.TestCase):
+    parser_class = Parser
+
     def setUp(self):
-        self.parser = Parser(3, u';', 'UNIX')
+        self.parser = self.parser_class(3, u';', 'UNIX')
 
     def tearDown(self):
         del self.parser
@@ -80,9 +125,35 @@ class TestUnquoted(unittest.TestCase):
         self.parser.strict = True
         self._test_fails_as_final(u"a;b;c")
 
+    def test_escapes_spliced_out_of_field(self):
+        self.parser.set_escapechar('BACKSLASH')
+        self._test(u"a\\;b\\;c;cd;ef\n", (u"a;b;c", u"cd", u"ef"))
+
+    def test_nullstring(self):
+        self.parser.add_nullstring(u"NULL")
+        self._test(u"ab;NULL;ef\n", (u"ab", None, u"ef"))
+
+    def test_startindex(self):
+        result = self.parser.parse(u"xx;yy;zz\nab;cd;ef\n", 9, False)
+        self.assertEqual(result, ((u"ab", u"cd", u"ef"), 18))
+
+    def test_long_field(self):
+        self._test(u"a"*10000 + u";cd;ef\n", (u"a"*10000, u"cd", u"ef"))
+
+    def test_long_field_with_spare_delimiters(self):
+        self.parser.allow_unquoted_delimiters_in_field(1)
+        self._test(u"ab;" + u"c;"*3000 + u"d;ef\n", (u"ab", u"c;"*3000 + u"d", u"ef"))
+
+    def test_wide_record(self):
+        self.parser.set_field_count(50)
+        fields = tuple(u"f%i" % i + u"x"*200 for i in range(50))
+        self._test(u";".join(fields) + u"\n", fields)
+
 class TestQuoted(unittest.TestCase):
+    parser_class = Parser
+
     def setUp(self):
-        self.parser = Parser(3, u';', 'UNIX')
+        self.parser = self.parser_class(3, u';', 'UNIX')
         self.parser.quoting = True
         self.parser.set_quotechar(u'"')
 
@@ -98,10 +169,897 @@ class TestQuoted(unittest.TestCase):
         self._test(u'"ab"ba;cd;ef\n', (u'"ab"ba', u"cd", u"ef"))
 
 
+    def test_doublequote(self):
+        self.parser.doublequote = True
+        self._test(u'"a""b""";cd;ef\n', (u'a"b"', u"cd", u"ef"))
+
+    def test_too_long_quoted_field_falls_back_to_unquoted(self):
+        self.parser.max_field_length = 2
+        self._test(u'"aaaa";cd;ef\n', (u'"aaaa"', u"cd", u"ef"))
+
+    def test_quoted_delimiters_and_linebreaks(self):
+        self._test(u'"a;\nb";"\r";ef\n', (u"a;\nb", u"\r", u"ef"))
+
     def test_unclosed(self):
         self.parser.max_field_length = 2
         self.parser.unclosedquoting = True
         self._test(u'"aaaa;cd;ef\n', (u"aaaa", u"cd", u"ef"))
 
+    def test_long_quoted_field(self):
+        self.parser.max_field_length = 20000
+        self._test(u'"' + u"a;"*5000 + u'";cd;ef\n', (u"a;"*5000, u"cd", u"ef"))
+
+class TestUnquotedCompiled(TestUnquoted):
+    parser_class = CompilingParser
+
+
+class TestQuotedCompiled(TestQuoted):
+    parser_class = CompilingParser
+
+
+class TestCompile(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'UNIX')
+        self.parser.compile()
+
+    def test_setter_invalidates(self):
+        self.parser.set_quotechar(u'"')
+        self.assertEqual(self.parser.compiled, None)
+        self.assertEqual(self.parser.parse(u'"a;b";c;d\n'), ((u"a;b", u"c", u"d"), 10))
+
+    def test_adder_invalidates(self):
+        self.parser.add_nullstring(u"NULL")
+        self.assertEqual(self.parser.compiled, None)
+
+    def test_assignment_invalidates(self):
+        self.parser.strict = True
+        self.assertEqual(self.parser.compiled, None)
+        self.assertRaises(BacktrackException, self.parser.parse, u"a;b;c")
+
+    def test_features_left_out(self):
+        source = self.parser.compiled.source
+        self.assertFalse("SPARE_DELIMITERS" in source)
+        self.assertFalse("RULES" in source)
+        self.assertFalse("'\"'" in source)
+
+
+class TestFailures(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(2, u';', 'UNIX')
+        self.parser.set_quotechar(u'"')
+
+    def test_exception_describes_last_failure(self):
+        try:
+            self.parser.parse(u'a;b;c\n')
+        except BacktrackException, e:
+            self.assertEqual(e.message, "Can't close")
+            self.assertEqual(e.index, 3)
+        else:
+            self.fail("Expected BacktrackException")
+
+    def test_needs_more_in_quoted_field(self):
+        self.assertRaises(IndexError, self.parser.parse, u'"a;b', 0, False)
+
+
+class TestMemoizeFailures(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(4, u';', 'UNIX')
+        self.parser.allow_unquoted_delimiters_in_field(1)
+        self.parser.allow_unquoted_delimiters_in_field(2)
+        self.parser.add_validation_rules(3, lambda field: field.startswith(u'z'))
+        self.parser.memoize_failures = True
+
+    def test_same_result(self):
+        buf = u'a;b;b;b;c;z\n'
+        self.assertEqual(self.parser.parse(buf), ((u"a", u"b;b;b", u"c", u"z"), len(buf)))
+
+    def test_bad_record_prunes_states(self):
+        buf = u'a;' + u'b;'*20 + u'c\n'
+        self.assertRaises(BacktrackException, self.parser.parse, buf)
+        self.assertTrue(self.parser.pruned_states > 0)
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'UNIX')
+        self.parser.allow_unquoted_delimiters_in_field(1)
+        self.calls = []
+        self.stats = self.parser.collect_stats(lambda *args: self.calls.append(args))
+
+    def test_counts(self):
+        buf = u'a;b;c\nd;e;f;g\n'
+        record, index = self.parser.parse(buf)
+        self.parser.parse(buf, index)
+        self.assertEqual(self.stats.records, 2)
+        self.assertEqual(self.stats.chars, len(buf))
+        self.assertEqual(self.stats.failed_records, 0)
+        self.assertTrue(self.stats.state_entries['start_field'] >= 6)
+        # Field 1 first takes every delimiter it's allowed, so emitting
+        # fails once for each record
+        self.assertEqual(self.stats.backtracks['emit'], 2)
+        self.assertEqual(self.calls, [(0, 6, self.calls[0][2], 1, None),
+                                      (6, len(buf), self.calls[1][2], 1, None)])
+
+    def test_failed_record(self):
+        self.assertRaises(BacktrackException, self.parser.parse, u'a;b\n')
+        self.assertEqual(self.stats.records, 0)
+        self.assertEqual(self.stats.failed_records, 1)
+        self.assertTrue(isinstance(self.calls[0][4], BacktrackException))
+
+    def test_disabled(self):
+        self.parser.stats = None
+        self.parser.parse(u'a;b;c\n')
+        self.assertEqual(self.stats.records, 0)
+
+
+class TestSelectFields(unittest.TestCase):
+    parser_class = Parser
+
+    def setUp(self):
+        self.parser = self.parser_class(4, u';', 'UNIX')
+        self.parser.set_quotechar(u'"')
+        self.parser.doublequote = True
+        self.parser.add_nullstring(u'N')
+        self.parser.select_fields([2, 0])
+
+    def test_projection(self):
+        buf = u'a;"b;""c";N;d\n'
+        self.assertEqual(self.parser.parse(buf), ((None, u"a"), len(buf)))
+
+    def test_unselected_fields_still_parsed(self):
+        self.parser.allow_unquoted_delimiters_in_field(1)
+        self.parser.add_validation_rules(1, lambda field: field.endswith(u'c'))
+        buf = u'a;b;c;d;e\n'
+        self.assertEqual(self.parser.parse(buf), ((u"d", u"a"), len(buf)))
+
+    def test_too_short_record_fails(self):
+        self.assertRaises(BacktrackException, self.parser.parse, u'a;b;c\n')
+
+    def test_select_all(self):
+        self.parser.select_fields(None)
+        self.assertEqual(self.parser.parse(u'a;b;c;d\n')[0], (u"a", u"b", u"c", u"d"))
+
+    def test_batches(self):
+        f = io.BytesIO(b'1;x;2;y\n3;x;4;y\n')
+        batch, = self.parser.iter_batches(f, types={0: 'int', 2: 'int'})
+        self.assertEqual(list(batch.records()), [(2, 1), (4, 3)])
+
+
+class TestSelectFieldsCompiled(TestSelectFields):
+    parser_class = CompilingParser
+
+
+class TestIntern(unittest.TestCase):
+    parser_class = Parser
+
+    def setUp(self):
+        self.parser = self.parser_class(3, u';', 'UNIX')
+        self.parser.add_nullstring(u'N')
+        self.parser.intern_field(1)
+
+    def _records(self, buf):
+        return list(self.parser.iter_records(io.BytesIO(buf.encode('utf-8'))))
+
+    def test_shared_values(self):
+        records = self._records(u'1;open;xx\n2;open;xx\n3;N;xx\n4;closed;xx\n')
+        self.assertEqual([r[1] for r in records], [u'open', u'open', None, u'closed'])
+        self.assertTrue(records[0][1] is records[1][1])
+        self.assertFalse(records[0][2] is records[1][2])
+
+    def test_parse_bytes(self):
+        buf = b'1;open;xx\n2;open;xx\n'
+        first, index = self.parser.parse_bytes(buf)
+        second, index = self.parser.parse_bytes(buf, index)
+        self.assertTrue(first[1] is second[1])
+
+    def test_high_cardinality_switches_off(self):
+        cache = self.parser.intern_caches[1]
+        cache.window = 100
+        records = self._records(u''.join(u'%i;%i;xx\n' % (i, i) for i in range(300)))
+        self.assertEqual(records[299][1], u'299')
+        self.assertFalse(cache.enabled)
+        self.assertEqual(len(cache), 0)
+
+
+class TestInternCompiled(TestIntern):
+    parser_class = CompilingParser
+
+
+class TestInternCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = InternCache(max_size=2, max_miss_rate=1.0)
+        a = u''.join([u'a', u'a'])
+        self.assertTrue(cache(a) is a)
+        cache(u'bb')
+        # a is moved back into the recent generation
+        self.assertTrue(cache(u''.join([u'a', u'a'])) is a)
+        cache(u'cc')
+        cache(u'dd')
+        self.assertTrue(cache(u''.join([u'a', u'a'])) is a)
+        cache(u'ee')
+        cache(u'ff')
+        cache(u'gg')
+        cache(u'hh')
+        self.assertFalse(cache(u''.join([u'a', u'a'])) is a)
+        self.assertTrue(len(cache) <= 4)
+
+    def test_low_cardinality_stays_on(self):
+        cache = InternCache(max_size=16, window=100)
+        for i in range(1000):
+            cache(unicode(i % 10))
+        self.assertTrue(cache.enabled)
+
+
+class CountingNumber(Number):
+    calls = 0
+
+    def __call__(self, field):
+        CountingNumber.calls += 1
+        return Number.__call__(self, field)
+
+
+class TestRules(unittest.TestCase):
+    def test_rules(self):
+        self.assertTrue(Regex(u'[A-Z]{2}')(u'GB'))
+        self.assertFalse(Regex(u'[A-Z]{2}')(u'GBR'))
+        self.assertTrue(Length(2, 3)(u'abc'))
+        self.assertFalse(Length(max_length=2)(u'abc'))
+        self.assertTrue(OneOf([u'open', u'closed'])(u'open'))
+        self.assertFalse(OneOf([u'open', u'closed'])(u'shut'))
+        self.assertTrue(Number(0, 10)(u'2.5'))
+        self.assertFalse(Number(0, 10, integer=True)(u'2.5'))
+        self.assertFalse(Number(0, 10)(u'11'))
+        self.assertFalse(All(Number(), Length(max_length=2))(u'123'))
+
+    def test_anchors_in_batches(self):
+        parser = Parser(1, u';', 'UNIX')
+        batch, = parser.iter_batches(io.BytesIO(b'GB\nFR\nde\nUS\n'))
+        rule = Regex(u'^[A-Z]{2}$')
+        self.assertEqual([rule(value) for value in batch[0]], [True, True, False, True])
+        self.assertEqual(validate_batch(batch, {0: rule}), {0: [2]})
+        self.assertEqual(validate_batch(batch, {0: Regex(u'(?<![A-Z])[A-Z]{2}')}), {0: [2]})
+
+    def test_rule_is_abstract(self):
+        self.assertRaises(TypeError, Rule)
+
+    def test_pickle(self):
+        rule = pickle.loads(pickle.dumps(All(Regex(u'\\d+'), OneOf([u'1', u'2']))))
+        self.assertTrue(rule(u'2'))
+        self.assertFalse(rule(u'3'))
+
+    def test_validate_batch(self):
+        parser = Parser(3, u';', 'UNIX')
+        parser.add_nullstring(u'N')
+        f = io.BytesIO(b'GB;10;ab\nGBR;20;abcd\nN;5;N\nfr;-1;abc\n')
+        batch, = parser.iter_batches(f, types={1: 'int'})
+        rules = {0: Regex(u'[A-Z]{2}'), 1: Number(0, 10), 2: All(Length(2, 3), OneOf([u'ab', u'abcd']))}
+        self.assertEqual(validate_batch(batch, rules), {0: [1, 3], 1: [1, 3], 2: [1, 3]})
+
+
+class TestValidationCache(unittest.TestCase):
+    parser_class = Parser
+
+    def setUp(self):
+        self.parser = self.parser_class(4, u',', 'UNIX')
+        self.parser.allow_unquoted_delimiters_in_field(0)
+        self.parser.allow_unquoted_delimiters_in_field(1)
+        self.parser.add_validation_rules(2, CountingNumber(integer=True))
+        CountingNumber.calls = 0
+
+    def test_retried_closes_reuse_results(self):
+        buf = u'1,2,3,4,5,6,7,8,9,x,y\n'
+        self.assertRaises(BacktrackException, self.parser.parse, buf)
+        # Once per span of field 2
+        self.assertTrue(CountingNumber.calls <= 9)
+        CountingNumber.calls = 0
+        self.assertRaises(BacktrackException, self.parser.parse, buf)
+        self.assertTrue(0 < CountingNumber.calls <= 9)
+
+    def test_results_are_per_record(self):
+        buf = u'a,b,1,x\na,b,c,x\n'
+        record, index = self.parser.parse(buf)
+        self.assertEqual(record, (u'a', u'b', u'1', u'x'))
+        self.assertRaises(BacktrackException, self.parser.parse, buf, index)
+
+
+class TestValidationCacheCompiled(TestValidationCache):
+    parser_class = CompilingParser
+
+
+class TestRecordLimits(unittest.TestCase):
+    parser_class = Parser
+
+    def setUp(self):
+        self.parser = self.parser_class(4, u';', 'UNIX')
+        self.parser.allow_unquoted_delimiters_in_field(1)
+        self.parser.allow_unquoted_delimiters_in_field(2)
+        self.parser.add_validation_rules(3, lambda field: field.startswith(u'z'))
+        self.bad = u'a;' + u'b;'*50 + u'c\n'
+
+    def _test_limit(self, limit):
+        try:
+            self.parser.parse(self.bad)
+        except RecordLimitException, e:
+            self.assertEqual(e.limit, limit)
+        else:
+            self.fail("No RecordLimitException")
+
+    def test_within_limits(self):
+        self.parser.max_backtracks = 10
+        self.parser.max_transitions = 100
+        self.parser.max_record_seconds = 10
+        buf = u'a;b;c;z\n'
+        self.assertEqual(self.parser.parse(buf), ((u"a", u"b", u"c", u"z"), len(buf)))
+
+    def test_max_backtracks(self):
+        self.parser.max_backtracks = 100
+        self._test_limit('backtracks')
+
+    def test_max_transitions(self):
+        self.parser.max_transitions = 1000
+        self._test_limit('transitions')
+
+    def test_max_record_seconds(self):
+        self.parser.max_record_seconds = 0
+        self._test_limit('seconds')
+
+    def test_rejected_in_lenient_mode(self):
+        self.parser.max_backtracks = 100
+        rejects = RejectLog()
+        f = io.StringIO(self.bad + u'a;b;c;z\n')
+        self.assertEqual(list(self.parser.iter_records(f, rejects=rejects)), [(u"a", u"b", u"c", u"z")])
+        self.assertEqual(rejects.rejects[0].message, "Too many backtracks")
+
+
+class TestRecordLimitsCompiled(TestRecordLimits):
+    parser_class = CompilingParser
+
+
+class TestIterRecords(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'UNIX')
+        self.parser.set_quotechar(u'"')
+
+    def _records(self, buf, chunk_size):
+        f = io.BytesIO(buf.encode('utf-8'))
+        return list(self.parser.iter_records(f, 'utf-8', chunk_size))
+
+    def test_records_across_chunks(self):
+        buf = u'ab;"c\nd";\u00e6\u00f8\u00e5\n' * 5
+        expected = [(u"ab", u"c\nd", u"\u00e6\u00f8\u00e5")] * 5
+        for chunk_size in (1, 2, 3, 7, 1000):
+            self.assertEqual(self._records(buf, chunk_size), expected)
+
+    def test_last_record_without_linebreak(self):
+        self.assertEqual(self._records(u"a;b;c\nd;e;f", 4), [(u"a", u"b", u"c"), (u"d", u"e", u"f")])
+
+    def test_empty_file(self):
+        self.assertEqual(self._records(u"", 4), [])
+
+    def test_text_file(self):
+        f = io.StringIO(u"a;b;c\nd;e;f\n")
+        self.assertEqual(list(self.parser.iter_records(f, chunk_size=3)), [(u"a", u"b", u"c"), (u"d", u"e", u"f")])
+
+    def test_bad_record_raises(self):
+        f = io.BytesIO(b"a;b;c\nd;e\n")
+        self.assertRaises(BacktrackException, list, self.parser.iter_records(f))
+
+    def test_bad_records_rejected(self):
+        rejects = RejectLog()
+        f = io.StringIO(u'a;b;c\nd;e\nf\ng;h;i\nj;k\nm;n;o')
+        records = list(self.parser.iter_records(f, chunk_size=4, rejects=rejects))
+        self.assertEqual(records, [(u"a", u"b", u"c"), (u"g", u"h", u"i"), (u"m", u"n", u"o")])
+        self.assertEqual(rejects.count, 2)
+        self.assertEqual([(r.offset, r.length) for r in rejects], [(6, 6), (18, 4)])
+        self.assertEqual(rejects.rejects[0].record, (u"d",))
+
+    def test_bad_end_of_file_rejected(self):
+        rejects = RejectLog()
+        f = io.StringIO(u'a;b;c\nd;e')
+        self.assertEqual(list(self.parser.iter_records(f, rejects=rejects)), [(u"a", u"b", u"c")])
+        self.assertEqual([(r.offset, r.length) for r in rejects], [(6, 3)])
+
+    def test_consecutive_bad_records_rejected_together(self):
+        rejects = RejectLog()
+        f = io.StringIO(u'a;b\n' * 100 + u'a;b;c\n')
+        self.assertEqual(list(self.parser.iter_records(f, chunk_size=16, rejects=rejects)), [(u"a", u"b", u"c")])
+        self.assertEqual(rejects.count, 1)
+        self.assertEqual(rejects.rejects[0].length, 400)
+
+    def test_rejects_are_capped(self):
+        rejects = RejectLog(capacity=5, seed=1)
+        f = io.StringIO(u'a;b\na;b;c\n' * 20)
+        self.assertEqual(len(list(self.parser.iter_records(f, rejects=rejects))), 20)
+        self.assertEqual(rejects.count, 20)
+        self.assertEqual(len(rejects), 5)
+
+class TestColumnBatch(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(4, u';', 'UNIX')
+        self.parser.add_nullstring(u"NULL")
+        self.types = {1: 'int', 2: 'float', 3: ('date', '%Y%m%d')}
+
+    def test_parse_batch(self):
+        buf = u"a;1;1.5;20150810\nNULL;NULL;;20150811\nc;3;3.5;\n"
+        batch = ColumnBatch(4, 10, self.types)
+        self.assertEqual(self.parser.parse_batch(batch, buf, 0, False), len(buf))
+        batch.finish()
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch[1].values), [1, 0, 3])
+        self.assertEqual([batch[0].is_null(i) for i in range(3)], [False, True, False])
+        self.assertEqual(list(batch.records()), [
+            (u"a", 1, 1.5, datetime.date(2015, 8, 10)),
+            (None, None, None, datetime.date(2015, 8, 11)),
+            (u"c", 3, 3.5, None)])
+
+    def test_parse_batch_stops_at_incomplete_record(self):
+        batch = ColumnBatch(4, 10)
+        self.assertEqual(self.parser.parse_batch(batch, u"a;b;c;d\ne;f", 0, False), 8)
+        self.assertEqual(len(batch), 1)
+
+    def test_iter_batches(self):
+        buf = u"".join(u"%i;%i;0.5;20150810\n" % (i, i) for i in range(25))
+        batches = list(self.parser.iter_batches(io.StringIO(buf), chunk_size=7, batch_size=10, types=self.types))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual(list(batches[2][1].values), range(20, 25))
+        self.assertEqual(batches[1][0][3], u"13")
+
+    @unittest.skipUnless(numpy, "NumPy isn't installed")
+    def test_to_numpy(self):
+        # Nulls in both bytes of the bitmaps
+        buf = u"".join(u"s%i;%i;%i.5;2015081%i\n" % (i, i, i, i) if i not in (1, 9) else u"NULL;;;\n"
+                       for i in range(10))
+        batch = ColumnBatch(4, 10, self.types)
+        self.parser.parse_batch(batch, buf)
+        batch.finish()
+        nulls = [i in (1, 9) for i in range(10)]
+        strings = batch[0].to_numpy()
+        self.assertEqual(strings.dtype, object)
+        self.assertEqual(list(strings), [None if i in (1, 9) else u"s%i" % i for i in range(10)])
+        for column in batch.columns[1:]:
+            self.assertEqual(list(numpy.ma.getmaskarray(column.to_numpy())), nulls)
+        ints = batch[1].to_numpy()
+        self.assertEqual(ints.dtype, numpy.dtype('l'))
+        self.assertEqual(list(ints.compressed()), [0, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(list(batch[2].to_numpy().compressed()), [0.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5, 8.5])
+        dates = batch[3].to_numpy()
+        self.assertEqual(dates.dtype, numpy.dtype('datetime64[D]'))
+        self.assertEqual(dates[2], numpy.datetime64('2015-08-12'))
+        self.assertEqual(list(dates.compressed().astype(object)),
+                         [datetime.date(2015, 8, 10 + i) for i in range(10) if i not in (1, 9)])
+
+    @unittest.skipUnless(numpy, "NumPy isn't installed")
+    def test_empty_to_numpy(self):
+        batch = ColumnBatch(4, 10, self.types).finish()
+        for column in batch.columns:
+            self.assertEqual(len(column.to_numpy()), 0)
+
+    def test_bad_value_raises(self):
+        batch = ColumnBatch(4, 10, self.types)
+        self.assertRaises(ValueError, self.parser.parse_batch, batch, u"a;b;c;d\n")
+
+    def test_failed_append_leaves_batch_unchanged(self):
+        batch = ColumnBatch(4, 10, self.types)
+        batch.append((u"a", u"1", u"1.5", u"20150810"))
+        self.assertRaises(ValueError, batch.append, (u"b", u"2", u"x", u"20150811"))
+        self.assertRaises(ValueError, batch.append, (u"b", u"9" * 30, u"2.5", u"20150811"))
+        batch.append((u"c", u"", u"3.5", u"20150812"))
+        batch.finish()
+        self.assertEqual(list(batch.records()), [
+            (u"a", 1, 1.5, datetime.date(2015, 8, 10)),
+            (u"c", None, 3.5, datetime.date(2015, 8, 12))])
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'UNIX')
+        self.parser.set_quotechar(u'"')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _test(self, buf, ranges_per_worker=8, record_index=None):
+        with open(self.path, 'wb') as f:
+            f.write(buf.encode('utf-8'))
+        with open(self.path, 'rb') as f:
+            expected = list(self.parser.iter_records(f, record_index=record_index))
+        result = list(parse_file_parallel(self.path, self.parser, 2, 'utf-8', ranges_per_worker, record_index))
+        self.assertEqual(result, expected)
+
+    def test_clean_file(self):
+        self._test(u''.join(u'%i;b\u00e6;c\n' % i for i in range(1000)))
+
+    def test_quoted_linebreaks_across_ranges(self):
+        # Most ranges start inside a quoted field
+        self._test(u''.join(u'%i;"\n;\n;\n";c\n' % i for i in range(200)), 50)
+
+    def test_records_longer_than_ranges(self):
+        self._test(u''.join(u'%i;"%s";c\n' % (i, u'\n'*(i % 300)) for i in range(100)), 50)
+
+    def test_ranges_from_record_index(self):
+        record_index = RecordIndex(10)
+        self._test(u''.join(u'%i;"\n;\n;\n";c\n' % i for i in range(200)), 50, record_index)
+        self.assertEqual(len(record_index), 20)
+
+    def test_record_limits_at_bad_seams(self):
+        # Ranges starting inside the quoted field run out of backtracks
+        self.parser = Parser(4, u';', 'UNIX')
+        self.parser.set_quotechar(u'"')
+        for i in range(3):
+            self.parser.allow_unquoted_delimiters_in_field(i)
+        self.parser.add_validation_rules(3, is_z)
+        self.parser.max_backtracks = 20
+        self._test(u''.join(u'%i;"\n%s\n";c;z\n' % (i, u';'*5) for i in range(200)), 50)
+
+    def test_exceptions_pickle(self):
+        e = pickle.loads(pickle.dumps(RecordLimitException("Too many backtracks", 'backtracks', 7)))
+        self.assertEqual((e.message, e.limit, e.index), ("Too many backtracks", 'backtracks', 7))
+        try:
+            self.parser.parse(u'a;b\n')
+        except BacktrackException, e:
+            e = pickle.loads(pickle.dumps(e))
+            self.assertEqual((e.message, e.index, e.record), ("Can't close", 4, (u'a',)))
+
+    def test_records_yielded_before_last_range(self):
+        self.parser.add_validation_rules(2, slow_z)
+        with open(self.path, 'wb') as f:
+            f.write(b'a;b;c\n' * 1000 + b'a;b;z\n')
+        started = time.time()
+        records = parse_file_parallel(self.path, self.parser, 2)
+        self.assertEqual(next(records), (u'a', u'b', u'c'))
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(len(list(records)), 1000)
+
+    def test_workers_compile(self):
+        init_worker(self.parser)
+        self.assertIsNotNone(self.parser.compiled)
+        parser = Parser(3, u';', 'UNIX')
+        parser.memoize_failures = True
+        init_worker(parser)
+        self.assertIsNone(parser.compiled)
+
+    def test_bad_record_raises(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'a;b;c\n' * 100 + b'a;b\n' + b'a;b;c\n' * 100)
+        self.assertRaises(BacktrackException, list, parse_file_parallel(self.path, self.parser, 2))
+
+
+class TestParseBytes(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'DOS')
+        self.parser.set_quotechar(u'"')
+        self.parser.doublequote = True
+        self.parser.add_nullstring(u'\u00f8')
+
+    def test_parse(self):
+        buf = u'\u00e6;"b;""\r\n";\u00f8\r\n'.encode('utf-8')
+        self.assertEqual(self.parser.parse_bytes(buf), ((u"\u00e6", u'b;"\r\n', None), len(buf)))
+
+    def test_latin_1(self):
+        buf = u'\u00e6;b;\u00f8\r\n'.encode('latin-1')
+        self.assertEqual(self.parser.parse_bytes(buf, 0, True, 'latin-1'), ((u"\u00e6", u"b", None), 7))
+
+    def test_needs_more(self):
+        self.assertRaises(IndexError, self.parser.parse_bytes, b'a;"b;', 0, False)
+
+    def test_not_ascii_compatible(self):
+        self.assertRaises(MetadataException, self.parser.parse_bytes, u'a;b;c'.encode('utf-16'), 0, True, 'utf-16')
+
+    def test_recompiled_after_change(self):
+        self.parser.parse_bytes(b'a;b;c\r\n')
+        self.parser.set_delimiter(u',')
+        self.assertEqual(self.parser.parse_bytes(b'a,b,c\r\n')[0], (u"a", u"b", u"c"))
+
+    def test_mmap(self):
+        buf = u''.join(u'%i;"\u00e6\r\n";\u00f8\r\n' % i for i in range(100))
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(buf.encode('utf-8'))
+            expected = list(self.parser.iter_records(io.BytesIO(buf.encode('utf-8'))))
+            self.assertEqual(list(self.parser.iter_mmap_records(path)), expected)
+        finally:
+            os.remove(path)
+
+
+class TestRecordIndex(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'UNIX')
+        self.parser.set_quotechar(u'"')
+        self.buf = u''.join(u'%i;"\u00e6\n\u00f8";%s\n' % (i, u'\u00e5' * (i % 7)) for i in range(100))
+        self.data = self.buf.encode('utf-8')
+        self.records = list(self.parser.iter_records(io.BytesIO(self.data)))
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _index(self, every, chunk_size=16):
+        record_index = RecordIndex(every)
+        records = list(self.parser.iter_records(io.BytesIO(self.data), 'utf-8', chunk_size, record_index=record_index))
+        self.assertEqual(records, self.records)
+        return record_index
+
+    def test_offsets(self):
+        record_index = self._index(1)
+        self.assertEqual(record_index.records, 100)
+        for i, offset in enumerate(record_index.offsets):
+            self.assertEqual(self.parser.parse(self.data[offset:].decode('utf-8'))[0], self.records[i])
+
+    def test_every_nth(self):
+        record_index = self._index(7)
+        self.assertEqual(len(record_index), 15)
+        self.assertEqual(record_index.offsets[1], self._index(1).offsets[7])
+
+    def test_seek_record(self):
+        record_index = self._index(7)
+        for n in (0, 6, 7, 50, 99, 100):
+            records = self.parser.seek_record(io.BytesIO(self.data), record_index, n)
+            self.assertEqual(list(records), self.records[n:])
+
+    def test_save_and_resume(self):
+        record_index = RecordIndex(4)
+        records = self.parser.iter_records(io.BytesIO(self.data), record_index=record_index)
+        for i in range(30):
+            next(records)
+        record_index.save(self.path)
+        # An interrupted load picks up after the last record it saved
+        record_index = RecordIndex.load(self.path)
+        self.assertEqual((record_index.every, record_index.records), (4, 30))
+        records = self.parser.resume_records(io.BytesIO(self.data), record_index)
+        self.assertEqual(list(records), self.records[30:])
+        self.assertEqual(list(record_index.offsets), list(self._index(4).offsets))
+
+
+class BufferCountingParser(Parser):
+    # Counts the characters of the buffers it's given
+    def parse(self, charbuffer, *args):
+        self.buffered += len(charbuffer)
+        return Parser.parse(self, charbuffer, *args)
+
+
+class TestRecordStream(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'UNIX')
+        self.parser.set_quotechar(u'"')
+        self.buf = u''.join(u'%i;"\u00e6\n\u00f8";%s\n' % (i, u'x' * (i * 13 % 300)) for i in range(100))
+        self.data = self.buf.encode('utf-8')
+        self.records = list(self.parser.iter_records(io.BytesIO(self.data)))
+
+    def _stream(self, chunk_size, limit=None, high_water=1 << 20):
+        stream = RecordStream(self.parser, high_water=high_water)
+        records = []
+        offset = 0
+        while not stream.at_end():
+            if stream.wants_data():
+                if offset < len(self.data):
+                    stream.feed(self.data[offset:offset+chunk_size])
+                    offset += chunk_size
+                else:
+                    stream.feed_eof()
+            records.extend(stream.parse_available(limit))
+        return records
+
+    def test_chunks(self):
+        for chunk_size in (1, 7, 100, 100000):
+            self.assertEqual(self._stream(chunk_size), self.records)
+
+    def test_limit(self):
+        self.assertEqual(self._stream(1000, limit=3), self.records)
+
+    def test_high_water(self):
+        # Records longer than high_water still get the data they need
+        self.assertEqual(self._stream(50, limit=1, high_water=10), self.records)
+
+    def test_no_final_linebreak(self):
+        stream = RecordStream(self.parser)
+        stream.feed(b'a;b;c\nd;e;f')
+        self.assertEqual(stream.parse_available(), [(u'a', u'b', u'c')])
+        self.assertFalse(stream.at_end())
+        stream.feed_eof()
+        self.assertEqual(stream.parse_available(), [(u'd', u'e', u'f')])
+        self.assertTrue(stream.at_end())
+        self.assertRaises(ValueError, stream.feed, b'g')
+
+    def test_long_record_returned_at_linebreak(self):
+        stream = RecordStream(self.parser)
+        stream.feed(b'a;b;' + b'c' * 100)
+        self.assertEqual(stream.parse_available(), [])
+        # Without a linebreak and less than doubled, so not parsed again
+        stream.feed(b'c' * 10)
+        self.assertEqual(stream.retry_at, 208)
+        self.assertEqual(stream.parse_available(), [])
+        stream.feed(b'c\n')
+        self.assertEqual(stream.parse_available(), [(u'a', u'b', u'c' * 111)])
+
+    def test_long_record_in_small_chunks(self):
+        # The buffer is only joined and parsed when it has doubled, so the
+        # work is linear in the length of the record
+        parser = BufferCountingParser(3, u';', 'UNIX')
+        parser.buffered = 0
+        stream = RecordStream(parser)
+        stream.feed(b'a;b;')
+        joins = 0
+        for i in range(5000):
+            charbuffer = stream.charbuffer
+            stream.feed(b'c' * 100)
+            self.assertEqual(stream.parse_available(), [])
+            joins += stream.charbuffer is not charbuffer
+        stream.feed(b'\n')
+        self.assertEqual(stream.parse_available(), [(u'a', u'b', u'c' * 500000)])
+        self.assertLess(joins, 20)
+        self.assertLess(parser.buffered, 4 * 500004)
+
+
+class TestFollow(unittest.TestCase):
+    def setUp(self):
+        self.parser = Parser(3, u';', 'UNIX')
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.checkpoint_path = self.path + '.checkpoint'
+
+    def tearDown(self):
+        for path in (self.path, self.checkpoint_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _append(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    def _follower(self):
+        return Follower(self.path, self.parser, checkpoint_path=self.checkpoint_path, poll_interval=0.01)
+
+    def test_appends(self):
+        self._append(b'a;b;c\nd;e')
+        records = self._follower().records(idle_timeout=0.2)
+        self.assertEqual(next(records), (u'a', u'b', u'c'))
+        self._append(b';f\ng;h;\xc3')
+        self.assertEqual(next(records), (u'd', u'e', u'f'))
+        self.assertEqual(list(records), [])
+        checkpoint = Checkpoint.load(self.checkpoint_path)
+        # The incomplete character is read again
+        self.assertEqual((checkpoint.offset, checkpoint.pending), (16, u'g;h;'))
+        self._append(b'\xa6\n')
+        self.assertEqual(list(self._follower().records(idle_timeout=0)), [(u'g', u'h', u'\xe6')])
+
+    def test_resume(self):
+        self._append(b'a;b;c\nd;e')
+        self.assertEqual(list(self._follower().records(idle_timeout=0)), [(u'a', u'b', u'c')])
+        self._append(b';f\n')
+        self.assertEqual(list(self._follower().records(idle_timeout=0)), [(u'd', u'e', u'f')])
+
+    def test_long_record_finished_by_short_append(self):
+        self._append(b'a;b;' + b'c' * 100)
+        # Appended after the follower has read the start of the record
+        timer = threading.Timer(0.1, self._append, [b'c\n'])
+        timer.start()
+        records = list(self._follower().records(idle_timeout=0.3))
+        timer.join()
+        self.assertEqual(records, [(u'a', u'b', u'c' * 101)])
+        self.assertEqual(Checkpoint.load(self.checkpoint_path).pending, u'')
+
+    def test_replaced_file(self):
+        self._append(b'a;b;c\n')
+        self.assertEqual(list(self._follower().records(idle_timeout=0)), [(u'a', u'b', u'c')])
+        os.remove(self.path)
+        self._append(b'x;y;z\n')
+        self.assertEqual(list(self._follower().records(idle_timeout=0)), [(u'x', u'y', u'z')])
+
+
+class TestWriter(unittest.TestCase):
+    def setUp(self):
+        self.dialect = Parser(3, u';', 'DOS')
+        self.dialect.set_quotechar(u'"')
+        self.dialect.doublequote = True
+        self.dialect.add_nullstring(u'NULL')
+
+    def _write(self, records, **kwargs):
+        out = io.BytesIO()
+        with Writer(out, self.dialect, **kwargs) as writer:
+            writer.write_records(records)
+        return out.getvalue()
+
+    def _round_trip(self, records):
+        data = self._write(records)
+        self.assertEqual(list(self.dialect.iter_records(io.BytesIO(data))), records)
+        return data
+
+    def test_minimal_quoting(self):
+        data = self._round_trip([(u'a', u'b;c', u'say "hi"'), (u'x\r\ny', None, u'\u00e6')])
+        self.assertEqual(data, u'a;"b;c";"say ""hi"""\r\n"x\r\ny";NULL;\u00e6\r\n'.encode('utf-8'))
+
+    def test_escapes(self):
+        self.dialect = Parser(3, u',', 'UNIX')
+        self.dialect.set_escapechar(u'\\')
+        self.dialect.skipinitialspace = True
+        data = self._round_trip([(u'a,b', u' c', u'\\d\n')])
+        self.assertEqual(data, b'a\\,b,\\ c,\\\\d\\\n\n')
+
+    def test_empty_nullstring(self):
+        self.dialect.add_nullstring(u'')
+        self.dialect.add_emptystring(u'EMPTY')
+        self.assertEqual(self._round_trip([(None, u'', u'a')]), b';EMPTY;a\r\n')
+
+    def test_unwritable_values(self):
+        self.assertRaises(ValueError, self._write, [(u'a', u'NULL', u'b')])
+        self.dialect = Parser(2, u',', 'UNIX')
+        self.assertRaises(ValueError, self._write, [(u'a', u'b,c')])
+
+    def test_long_fields(self):
+        # Quoted fields can't be longer than max_field_length
+        long_field = u'a;"' * 400
+        self._round_trip([(long_field[:1000], u'b', u'c')])
+        self.assertRaises(ValueError, self._write, [(long_field, u'b', u'c')])
+        self.dialect.set_escapechar(u'\\')
+        data = self._round_trip([(long_field, u'b', u'c\r\n' * 600)])
+        self.assertEqual(data, (u'a\\;\\"' * 400 + u';b;' + u'c\\\r\\\n' * 600 + u'\r\n').encode('utf-8'))
+
+    def test_values_converted(self):
+        self.assertEqual(self._write([(1, 2.5, u'x')]), b'1;2.5;x\r\n')
+
+    def test_buffered(self):
+        records = [(u'a', unicode(i), u'c') for i in range(1000)]
+        self.assertEqual(self._write(records, buffer_size=100), self._write(records))
+
+    def test_transcode(self):
+        src = Parser(3, u',', 'UNIX')
+        src.add_nullstring(u'\\N')
+        infile = io.BytesIO(b'a,b;c,\\N\nd,e,f\n')
+        outfile = io.BytesIO()
+        self.assertEqual(transcode(infile, outfile, src, self.dialect), 2)
+        self.assertEqual(outfile.getvalue(), b'a;"b;c";NULL\r\nd;e;f\r\n')
+
+
+class TestSniff(unittest.TestCase):
+    def test_clean(self):
+        parser, confidence = sniff(u''.join(u'%i;name %i;%i.5\r\n' % (i, i, i) for i in range(50)))
+        self.assertEqual((parser.field_count, parser.delimiter, parser.newline), (3, u';', u'DOS'))
+        self.assertFalse(parser.quoting)
+        self.assertEqual(confidence, 1.0)
+
+    def test_bytes(self):
+        parser, confidence = sniff(b'a\tb\n' * 20)
+        self.assertEqual((parser.field_count, parser.delimiter, parser.newline), (2, u'\t', u'UNIX'))
+
+    def test_spare_delimiters(self):
+        rows = [u'%i;name %i;%i.5' % (i, i, i) for i in range(50)]
+        rows[5] = u'5;Smith; John;5.5'
+        parser, confidence = sniff(u'\n'.join(rows) + u'\n')
+        self.assertEqual(parser.field_count, 3)
+        self.assertEqual(parser.allow_unquoted_delimiters_in, set([1]))
+        self.assertEqual(confidence, 1.0)
+
+    def test_spare_delimiters_among_text_columns(self):
+        # Fields 1 and 3 can't be told from their text neighbours
+        rows = [u'a%i;%s;%i;%s;d;e' % (i, u';'.join([u'b'] * (i % 4 + 1)), i, u';'.join([u'c'] * (i // 4 % 4 + 1)))
+                for i in range(64)]
+        parser, confidence = sniff(u'\n'.join(rows) + u'\n')
+        self.assertEqual(parser.field_count, 6)
+        self.assertEqual(parser.allow_unquoted_delimiters_in, set())
+        self.assertLess(confidence, 0.5)
+
+    def test_spare_linebreaks(self):
+        rows = [u'%i,line %i,%i' % (i, i, i) for i in range(30)]
+        rows[3] = u'3,first\nsecond,3'
+        parser, confidence = sniff(u'\n'.join(rows) + u'\n')
+        self.assertEqual(parser.allow_unquoted_linebreaks_in, set([1]))
+        self.assertEqual(confidence, 1.0)
+
+    def test_quoting(self):
+        parser, confidence = sniff(u'id|text\n1|"a|b"\n2|"say ""hi"""\n3|"open\n4|NULL\n')
+        self.assertEqual((parser.field_count, parser.quotechar), (2, u'"'))
+        self.assertTrue(parser.doublequote)
+        self.assertTrue(parser.unclosedquoting)
+        self.assertEqual(parser.nullstrings, set([u'NULL']))
+        self.assertEqual(confidence, 1.0)
+
+    def test_no_delimiter(self):
+        self.assertRaises(MetadataException, sniff, u'abc\ndef\n')
+
+
 if __name__=="__main__":
     unittest.main()